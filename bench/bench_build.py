@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Benchmark building trees from large nested dicts.
+
+The same data is turned into a tree with the :class:`Struct`
+constructor and with :meth:`Struct.from_mapping`, both trusting the
+keys and validating each one.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_data(keys, width, depth):
+    data = {}
+    for s in xrange(keys // width):
+        child = data.setdefault("s%d" % s, {})
+        for d in xrange(depth):
+            child = child.setdefault("n%d" % d, {})
+        for i in xrange(width):
+            if i % 2:
+                child["k%d" % i] = "value %d" % i
+            else:
+                child["k%d" % i] = i
+    return data
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-k", "--keys", type="int", default=1000000,
+            help="total number of values in the tree")
+    opts.add_option("-w", "--width", type="int", default=100,
+            help="number of values in each struct")
+    opts.add_option("-d", "--depth", type="int", default=2,
+            help="depth of the structs holding the values")
+    options, args = opts.parse_args()
+
+    data = build_data(options.keys, options.width, options.depth)
+
+    start = time.time()
+    struct.Struct(data)
+    stop = time.time()
+    sys.stdout.write("Struct:       %.3fs\n" % (stop - start))
+
+    if hasattr(struct.Struct, 'from_mapping'):
+        start = time.time()
+        struct.Struct.from_mapping(data)
+        stop = time.time()
+        sys.stdout.write("from_mapping: %.3fs\n" % (stop - start))
+
+        start = time.time()
+        struct.Struct.from_mapping(data, trusted=False)
+        stop = time.time()
+        sys.stdout.write("untrusted:    %.3fs\n" % (stop - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Benchmark comparing large trees.
+
+A running tree is compared against a freshly built equal tree and
+against one with a single changed value, as is done when deciding
+whether a config needs to be reloaded.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(structs, width):
+    root = struct.Struct()
+    for s in xrange(structs):
+        child = struct.Struct(container=root, name="s%d" % s)
+        root["s%d" % s] = child
+        for i in xrange(width):
+            if i % 2:
+                child["k%d" % i] = "value %d" % i
+            else:
+                child["k%d" % i] = [i, i + 1]
+    return root
+
+
+def timeit(name, func, count):
+    start = time.time()
+    for i in xrange(count):
+        func()
+    stop = time.time()
+    sys.stdout.write("%-14s %.3fs\n" % (name + ":", stop - start))
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=5000,
+            help="number of structs in the tree")
+    opts.add_option("-w", "--width", type="int", default=20,
+            help="number of values in each struct")
+    opts.add_option("-n", "--count", type="int", default=10,
+            help="number of times each comparison is done")
+    options, args = opts.parse_args()
+
+    running = build_tree(options.structs, options.width)
+    same = build_tree(options.structs, options.width)
+    changed = build_tree(options.structs, options.width)
+    changed["s%d.k1" % (options.structs - 1)] = "changed"
+
+    if hasattr(running, 'content_hash'):
+        timeit("first hash", running.content_hash, 1)
+        timeit("cached hash", running.content_hash, options.count)
+        same.content_hash()
+        changed.content_hash()
+    timeit("equal", lambda: running == same, options.count)
+    timeit("changed", lambda: running == changed, options.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark converting large trees to plain Python objects.
+
+The tree is copied into dicts and lists with :meth:`Struct.dict`
+and into read-only dicts and tuples with ``dict(immutable=True)``.
+The read-only copy is cached, so it is timed on fresh copies of the
+tree, after changing a single value each time, and from the cache.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(structs, width, depth):
+    root = struct.Struct()
+    for s in xrange(structs):
+        path = ".".join(["s%d" % s] + ["n%d" % d for d in xrange(depth)])
+        for i in xrange(width):
+            if i % 3 == 0:
+                root.set("%s.k%d" % (path, i), [i, [str(i)]])
+            elif i % 3 == 1:
+                root.set("%s.k%d" % (path, i), "value %d" % i)
+            else:
+                root.set("%s.k%d" % (path, i), i)
+    return root
+
+
+def timeit(name, func, count):
+    start = time.time()
+    for i in xrange(count):
+        func()
+    stop = time.time()
+    sys.stdout.write("%-10s %.3fs\n" % (name + ":", stop - start))
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=2000,
+            help="number of top level structs")
+    opts.add_option("-w", "--width", type="int", default=30,
+            help="number of values in each struct")
+    opts.add_option("-d", "--depth", type="int", default=3,
+            help="depth of the values in each top level struct")
+    opts.add_option("-n", "--count", type="int", default=5,
+            help="number of times the tree is converted")
+    options, args = opts.parse_args()
+
+    root = build_tree(options.structs, options.width, options.depth)
+
+    timeit("dict", root.dict, options.count)
+    try:
+        root.dict(immutable=True)
+    except TypeError:
+        pass
+    else:
+        trees = iter([root.copy() for i in xrange(options.count)])
+        timeit("immutable", lambda: trees.next().dict(immutable=True),
+                options.count)
+        path = ".".join(["s0"] + ["n%d" % d for d in xrange(options.depth)]
+                        + ["k2"])
+        values = iter(xrange(options.count))
+        def change():
+            root[path] = values.next()
+            root.dict(immutable=True)
+        timeit("changed", change, options.count)
+        timeit("cached", lambda: root.dict(immutable=True), options.count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark diffing large trees of near identical hosts.
+
+A fleet of hosts sharing most of their settings is compared with a
+copy where a few hosts changed: with freshly built trees, with the
+content hashes of both trees already cached, and with only the old
+tree's hashes cached as when checking a newly parsed config against
+the running one. For reference the flattened settings of both trees
+are also compared.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(hosts, width, changed=()):
+    root = struct.Struct()
+    for h in xrange(hosts):
+        host = struct.Struct(container=root, name="host%d" % h)
+        root["host%d" % h] = host
+        host["name"] = "host%d" % h
+        for i in xrange(width):
+            host.set("settings.k%d" % i, i)
+            host.set("ports.p%d" % i, [i, i + 1])
+        if h in changed:
+            host["settings.k0"] = -1
+    return root
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-n", "--hosts", type="int", default=5000,
+            help="number of hosts in the tree")
+    opts.add_option("-w", "--width", type="int", default=20,
+            help="number of settings for each host")
+    opts.add_option("-c", "--changed", type="int", default=10,
+            help="number of hosts that differ")
+    options, args = opts.parse_args()
+
+    changed = range(0, options.hosts, options.hosts // options.changed)
+    old = build_tree(options.hosts, options.width)
+    new = build_tree(options.hosts, options.width, changed)
+
+    start = time.time()
+    flat = dict(old.flatten())
+    differ = [p for p, v in new.flatten() if flat.get(p) != v]
+    stop = time.time()
+    sys.stdout.write("flattened: %.3fs (%d paths)\n" %
+            (stop - start, len(differ)))
+
+    start = time.time()
+    result = struct.diff(old, new)
+    stop = time.time()
+    sys.stdout.write("diff:      %.3fs (%d paths)\n" %
+            (stop - start, sum(len(paths) for paths in result)))
+
+    start = time.time()
+    struct.diff(old, new)
+    stop = time.time()
+    sys.stdout.write("cached:    %.3fs\n" % (stop - start))
+
+    new = build_tree(options.hosts, options.width, changed)
+    start = time.time()
+    struct.diff(old, new)
+    stop = time.time()
+    sys.stdout.write("new tree:  %.3fs\n" % (stop - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Benchmark expanding large, heavily linked trees.
+
+Every host struct links into a shared chain of settings, each of which
+refers to the previous one, so naive expansion re-resolves the chain
+once per reference.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+import coil
+
+
+def build_text(hosts, chain):
+    # Hosts come first so the chain has not been expanded yet
+    # when the first references to it are found.
+    lines = []
+    for h in xrange(hosts):
+        lines.append("host%d: {" % h)
+        lines.append("    name: 'host%d'" % h)
+        lines.append("    setting: =@root.common.last")
+        lines.append("    fqdn: '${name}.${@root.common.s%d}'" % (h % chain))
+        lines.append("}")
+
+    lines.extend(["common: {", "    s0: 'base'"])
+    for i in xrange(1, chain):
+        lines.append("    s%d: '${s%d}.%d'" % (i, i - 1, i))
+    lines.append("    last: =s%d" % (chain - 1))
+    lines.append("}")
+
+    return lines
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-n", "--hosts", type="int", default=2000,
+            help="number of structs referring to the shared chain")
+    opts.add_option("-c", "--chain", type="int", default=50,
+            help="length of the shared reference chain")
+    opts.add_option("-d", "--defaults", type="int", default=0,
+            help="number of (unused) defaults and ignore_missing keys")
+    options, args = opts.parse_args()
+
+    text = build_text(options.hosts, options.chain)
+    root = coil.parse("\n".join(text), expand=False)
+    defaults = dict(("default%d" % i, i) for i in xrange(options.defaults))
+    ignore = ["ignore%d" % i for i in xrange(options.defaults)]
+
+    start = time.time()
+    root.expand(defaults, ignore)
+    stop = time.time()
+
+    sys.stdout.write("expand: %.3fs\n" % (stop - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Benchmark sharing a tree between requests.
+
+Each request either reads from its own :meth:`Struct.copy` of the
+shared tree, as is needed when the tree is mutable, or directly from
+the tree once it has been made immutable with :meth:`Struct.freeze`.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(structs, width):
+    root = struct.Struct()
+    for s in xrange(structs):
+        child = struct.Struct(container=root, name="s%d" % s)
+        root["s%d" % s] = child
+        for i in xrange(width):
+            if i % 2:
+                child["k%d" % i] = "value %d" % i
+            else:
+                child["k%d" % i] = [i, i + 1]
+    return root
+
+
+def request(root, structs):
+    for s in xrange(0, structs, 10):
+        root.get("s%d.k1" % s)
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=1000,
+            help="number of structs in the tree")
+    opts.add_option("-w", "--width", type="int", default=20,
+            help="number of values in each struct")
+    opts.add_option("-n", "--requests", type="int", default=20,
+            help="number of requests reading the tree")
+    options, args = opts.parse_args()
+
+    root = build_tree(options.structs, options.width)
+
+    start = time.time()
+    for i in xrange(options.requests):
+        request(root.copy(), options.structs)
+    stop = time.time()
+    sys.stdout.write("copy:   %.3fs\n" % (stop - start))
+
+    if hasattr(root, 'freeze'):
+        start = time.time()
+        root.freeze()
+        for i in xrange(options.requests):
+            request(root, options.structs)
+        stop = time.time()
+        sys.stdout.write("freeze: %.3fs\n" % (stop - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""Benchmark garbage collection while configs are reloaded.
+
+A large tree is parsed and then repeatedly replaced by a fresh parse
+of the same text, as a long running service would on reload. Every
+dropped tree is left for the cyclic garbage collector unless weak
+container links are used, in which case reference counting frees it
+as soon as the last reference goes away.
+"""
+
+import gc
+import sys
+import time
+from optparse import OptionParser
+
+from coil import parser
+
+
+def build_text(structs, width):
+    lines = ["k0: 0", "base: { ref: =..k0 text: '${..k0}' }"]
+    for s in xrange(structs):
+        lines.append("s%d: {" % s)
+        for i in xrange(width):
+            lines.append("    k%d: %d" % (i, i))
+        lines.append("    sub: { @extends: @root.base }")
+        lines.append("}")
+    return lines
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=2000,
+            help="number of structs in the tree")
+    opts.add_option("-w", "--width", type="int", default=10,
+            help="number of values in each struct")
+    opts.add_option("-n", "--reloads", type="int", default=5,
+            help="number of times the tree is replaced")
+    opts.add_option("--weak", action="store_true", default=False,
+            help="use weak container links")
+    options, args = opts.parse_args()
+
+    text = build_text(options.structs, options.width)
+    gc.collect()
+    gc.disable()
+
+    root = parser.Parser(text, weak_links=options.weak).root()
+    start = time.time()
+    for i in xrange(options.reloads):
+        root = parser.Parser(text, weak_links=options.weak).root()
+    reloaded = time.time()
+    garbage = gc.collect()
+    collected = time.time()
+    gc.collect()
+    start_full = time.time()
+    gc.collect()
+    stop_full = time.time()
+    gc.enable()
+
+    sys.stdout.write("reload:      %.3fs\n" % (reloaded - start))
+    sys.stdout.write("unreachable: %d objects\n" % garbage)
+    sys.stdout.write("collect:     %.3fs\n" % (collected - reloaded))
+    sys.stdout.write("live scan:   %.3fs (%d tracked objects)\n" %
+            (stop_full - start_full, len(gc.get_objects())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Benchmark deep lookups in an expanded tree.
+
+Paths are fetched from the root and relative to the deepest struct,
+both as strings and as compiled :class:`coil.struct.Path` objects,
+and then again with the absolute path index enabled.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(depth, width):
+    root = struct.Struct()
+    paths = []
+    for w in xrange(width):
+        keys = ["b%d" % w] + ["n%d" % d for d in xrange(depth - 1)]
+        path = ".".join(keys)
+        root.set(path, w)
+        paths.append("@root." + path)
+    return root, paths
+
+
+def timeit(name, func, paths, count):
+    start = time.time()
+    for i in xrange(count):
+        for path in paths:
+            func(path)
+    stop = time.time()
+    sys.stdout.write("%-12s %.3fs\n" % (name + ":", stop - start))
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-d", "--depth", type="int", default=8,
+            help="number of components in each path")
+    opts.add_option("-w", "--width", type="int", default=100,
+            help="number of distinct paths")
+    opts.add_option("-n", "--count", type="int", default=1000,
+            help="number of times each path is fetched")
+    options, args = opts.parse_args()
+
+    root, paths = build_tree(options.depth, options.width)
+    deep = root.get(paths[0].rsplit('.', 1)[0])
+    compiled = [struct.Path.compile(p) for p in paths]
+
+    timeit("root", root.get, paths, options.count)
+    timeit("deep", deep.get, paths, options.count)
+    timeit("compiled", root.get, compiled, options.count)
+
+    root.use_index()
+    timeit("index root", root.get, paths, options.count)
+    timeit("index deep", deep.get, paths, options.count)
+    timeit("get_many", root.get_many, [paths], options.count)
+
+if __name__ == '__main__':
+    main()
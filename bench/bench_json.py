@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Benchmark converting trees to and from JSON.
+
+Each direction is timed both through plain dicts, which is what
+:meth:`Struct.dict` with :func:`json.dumps` and :class:`Struct` with
+:func:`json.loads` do, and directly with :meth:`Struct.to_json` and
+:meth:`Struct.from_json`.
+"""
+
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(structs, width, depth):
+    root = struct.Struct()
+    for s in xrange(structs):
+        path = ".".join(["s%d" % s] + ["n%d" % d for d in xrange(depth)])
+        for i in xrange(width):
+            if i % 2:
+                root.set("%s.k%d" % (path, i), "value %d" % i)
+            else:
+                root.set("%s.k%d" % (path, i), i)
+    return root
+
+
+def report(name, size, seconds):
+    sys.stdout.write("%-10s %.3fs (%.1f MiB/s)\n" % (name + ":", seconds,
+            size / 1048576.0 / max(seconds, 1e-6)))
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=5000,
+            help="number of top level structs")
+    opts.add_option("-w", "--width", type="int", default=20,
+            help="number of values in each struct")
+    opts.add_option("-d", "--depth", type="int", default=3,
+            help="depth of the values in each top level struct")
+    options, args = opts.parse_args()
+
+    root = build_tree(options.structs, options.width, options.depth)
+
+    start = time.time()
+    text = json.dumps(root.dict())
+    stop = time.time()
+    sys.stdout.write("size:      %.1f MiB\n" % (len(text) / 1048576.0))
+    report("dict dump", len(text), stop - start)
+
+    if hasattr(root, 'to_json'):
+        output = open(os.devnull, 'w')
+        start = time.time()
+        root.to_json(output)
+        stop = time.time()
+        output.close()
+        report("to_json", len(text), stop - start)
+
+    start = time.time()
+    struct.Struct(json.loads(text))
+    stop = time.time()
+    report("dict load", len(text), stop - start)
+
+    if hasattr(struct.Struct, 'from_json'):
+        start = time.time()
+        struct.Struct.from_json(text)
+        stop = time.time()
+        report("from_json", len(text), stop - start)
+
+if __name__ == '__main__':
+    main()
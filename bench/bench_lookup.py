@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark lookups of missing items.
+
+Every host struct refers to several keys which only exist in the
+expansion defaults or are ignored, and the expanded tree is then
+queried for keys which are mostly missing.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+import coil
+
+
+def build_text(hosts, refs):
+    lines = []
+    for h in xrange(hosts):
+        lines.append("host%d: {" % h)
+        lines.append("    name: 'host%d'" % h)
+        for r in xrange(refs):
+            lines.append("    d%d: '${default%d}'" % (r, r))
+            lines.append("    i%d: '${ignore%d}'" % (r, r))
+            lines.append("    l%d: =ignore%d" % (r, r))
+        lines.append("}")
+
+    return lines
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-n", "--hosts", type="int", default=2000,
+            help="number of structs referring to missing keys")
+    opts.add_option("-r", "--refs", type="int", default=10,
+            help="number of missing keys referred to by each struct")
+    options, args = opts.parse_args()
+
+    text = build_text(options.hosts, options.refs)
+    root = coil.parse("\n".join(text), expand=False)
+    defaults = dict(("default%d" % i, i) for i in xrange(options.refs))
+    ignore = ["ignore%d" % i for i in xrange(options.refs)]
+
+    start = time.time()
+    root.expand(defaults, ignore)
+    expanded = time.time()
+    for h in xrange(options.hosts):
+        host = root["host%d" % h]
+        for r in xrange(options.refs):
+            host.get("missing%d" % r, None)
+            root.get("host%d.missing.x%d" % (h, r), None)
+    fetched = time.time()
+
+    sys.stdout.write("expand: %.3fs\n" % (expanded - start))
+    sys.stdout.write("get:    %.3fs\n" % (fetched - expanded))
+
+if __name__ == '__main__':
+    main()
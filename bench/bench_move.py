@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Benchmark moving large subtrees between trees.
+
+A subtree of many nested structs is repeatedly re-parented, which
+should not depend on the size of the subtree.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(width, depth):
+    sub = struct.Struct()
+    for w in xrange(width):
+        path = ".".join(["b%d" % w] + ["n%d" % d for d in xrange(depth)])
+        sub.set(path, w)
+    return sub
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-w", "--width", type="int", default=1000,
+            help="number of branches in the moved subtree")
+    opts.add_option("-d", "--depth", type="int", default=10,
+            help="depth of each branch")
+    opts.add_option("-n", "--moves", type="int", default=1000,
+            help="number of times the subtree is moved")
+    options, args = opts.parse_args()
+
+    sub = build_tree(options.width, options.depth)
+    roots = [struct.Struct(), struct.Struct()]
+
+    start = time.time()
+    for i in xrange(options.moves):
+        roots[i % 2]["moved%d" % i] = sub
+    moved = time.time()
+    path = "b0" + "".join(".n%d" % d for d in xrange(options.depth - 1))
+    sub.get(path).node_path
+    stop = time.time()
+
+    sys.stdout.write("move:   %.3fs\n" % (moved - start))
+    sys.stdout.write("lookup: %.3fs\n" % (stop - moved))
+
+if __name__ == '__main__':
+    main()
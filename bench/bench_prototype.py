@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Benchmark extending very wide structs during parsing.
+
+A base struct with many keys is extended by several children which
+override and delete a fraction of the inherited keys.
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from coil import parser
+
+
+def build_text(keys, children, override):
+    lines = ["base: {"]
+    for i in xrange(keys):
+        lines.append("    key%d: %d" % (i, i))
+    lines.append("}")
+
+    for c in xrange(children):
+        lines.append("child%d: {" % c)
+        lines.append("    @extends: ..base")
+        for i in xrange(0, keys, override):
+            lines.append("    key%d: 'override %d'" % (i, c))
+        for i in xrange(1, keys, override * 2):
+            lines.append("    ~key%d" % i)
+        lines.append("}")
+
+    return lines
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-k", "--keys", type="int", default=10000,
+            help="number of keys in the base struct")
+    opts.add_option("-c", "--children", type="int", default=5,
+            help="number of structs extending the base")
+    opts.add_option("-o", "--override", type="int", default=10,
+            help="override every Nth inherited key")
+    options, args = opts.parse_args()
+
+    text = build_text(options.keys, options.children, options.override)
+
+    start = time.time()
+    proto = parser.Parser(text, expand=False).prototype()
+    parsed = time.time()
+    for c in xrange(options.children):
+        for key in proto["child%d" % c]:
+            pass
+    iterated = time.time()
+
+    sys.stdout.write("parse+extend: %.3fs\n" % (parsed - start))
+    sys.stdout.write("iterate:      %.3fs\n" % (iterated - parsed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Benchmark converting large trees to the coil text format.
+
+The tree is converted to a string, written to a file, and flattened
+into lines of full paths as coildump -f does. The time for each
+should grow linearly with the size of the output.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def build_tree(structs, width, depth):
+    root = struct.Struct()
+    for s in xrange(structs):
+        path = ".".join(["s%d" % s] + ["n%d" % d for d in xrange(depth)])
+        for i in xrange(width):
+            if i % 2:
+                root.set("%s.k%d" % (path, i), "value %d" % i)
+            else:
+                root.set("%s.k%d" % (path, i), i)
+    return root
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-s", "--structs", type="int", default=2000,
+            help="number of top level structs")
+    opts.add_option("-w", "--width", type="int", default=20,
+            help="number of values in each struct")
+    opts.add_option("-d", "--depth", type="int", default=3,
+            help="depth of the values in each top level struct")
+    options, args = opts.parse_args()
+
+    root = build_tree(options.structs, options.width, options.depth)
+
+    start = time.time()
+    text = root.string()
+    converted = time.time()
+    if hasattr(root, 'write'):
+        output = open(os.devnull, 'w')
+        root.write(output)
+        output.close()
+    written = time.time()
+    if hasattr(root, 'flatten'):
+        output = open(os.devnull, 'w')
+        for path, value in root.flatten():
+            output.write("%s: %r\n" % (path, value))
+        output.close()
+    flattened = time.time()
+
+    sys.stdout.write("size:    %.1f MiB\n" % (len(text) / 1048576.0))
+    sys.stdout.write("string:  %.3fs\n" % (converted - start))
+    sys.stdout.write("write:   %.3fs\n" % (written - converted))
+    sys.stdout.write("flatten: %.3fs\n" % (flattened - written))
+
+if __name__ == '__main__':
+    main()
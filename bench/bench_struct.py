@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Benchmark memory use and basic operations on leaf heavy trees.
+
+Builds a tree of plain values spread over structs of a fixed width
+and reports the memory it takes along with the time to build, read,
+update, and iterate over it.
+"""
+
+import resource
+import sys
+import time
+from optparse import OptionParser
+
+from coil import struct
+
+
+def maxrss():
+    """Peak memory use of this process in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    opts = OptionParser("Usage: %prog [options]")
+    opts.add_option("-k", "--keys", type="int", default=100000,
+            help="total number of values in the tree")
+    opts.add_option("-w", "--width", type="int", default=100,
+            help="number of values in each struct")
+    options, args = opts.parse_args()
+
+    keys = ["key%d" % i for i in xrange(options.width)]
+    count = options.keys // options.width
+
+    before = maxrss()
+    start = time.time()
+    root = struct.Struct()
+    for s in xrange(count):
+        child = struct.Struct(container=root, name="s%d" % s)
+        root["s%d" % s] = child
+        for i, key in enumerate(keys):
+            if i % 2:
+                child[key] = "value %d" % i
+            else:
+                child[key] = i
+    built = time.time()
+    memory = maxrss() - before
+
+    for s in xrange(count):
+        child = root["s%d" % s]
+        for key in keys:
+            child[key]
+    fetched = time.time()
+
+    for s in xrange(count):
+        child = root["s%d" % s]
+        for key in keys:
+            child[key] = 0
+    updated = time.time()
+
+    for child in root.itervalues():
+        for value in child.itervalues():
+            pass
+    iterated = time.time()
+
+    sys.stdout.write("memory:  %.1f MiB (%d bytes per value)\n" %
+            (memory / 1024.0, memory * 1024 / max(options.keys, 1)))
+    sys.stdout.write("build:   %.3fs\n" % (built - start))
+    sys.stdout.write("get:     %.3fs\n" % (fetched - built))
+    sys.stdout.write("set:     %.3fs\n" % (updated - fetched))
+    sys.stdout.write("iterate: %.3fs\n" % (iterated - updated))
+
+if __name__ == '__main__':
+    main()
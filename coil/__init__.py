@@ -6,9 +6,11 @@
 
 __version_info__ = (0,3,99)
 __version__ = ".".join([str(x) for x in __version_info__])
-__all__ = ['struct', 'parser', 'tokenizer', 'errors']
+__all__ = ['struct', 'parser', 'tokenizer', 'errors', 'handle']
 
 from coil.parser import Parser
+from coil.struct import diff
+from coil.handle import ConfigHandle
 
 def parse_file(file_name, **kwargs):
     """Open and parse a coil file.
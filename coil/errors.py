@@ -39,16 +39,6 @@ class NodeError(CoilError):
         else:
             return "<%s> %s" % (self.node_path, self.reason)
 
-class CircularReference(NodeError):
-    """Failed to resolve a :class:`Link` or other reference
-    due to a circular reference in the coil tree.
-    """
-
-    def __init__(self, node, link_path):
-        self.link_path = link_path
-        reason = "Circular reference to %s" % link_path
-        super(NodeError, self).__init__(node, reason)
-
 class StructError(NodeError):
     """Generic error for :class:`coil.struct.Struct` objects"""
 
@@ -58,6 +48,16 @@ class StructError(NodeError):
         return self.node_path
 
 
+class CircularReference(StructError):
+    """Failed to resolve a :class:`Link` or other reference
+    due to a circular reference in the coil tree.
+    """
+
+    def __init__(self, struct, link_path):
+        self.link_path = link_path
+        reason = "Circular reference to %s" % link_path
+        StructError.__init__(self, struct, reason)
+
 class KeyMissingError(StructError, KeyError):
     """The given key was not found"""
 
@@ -88,6 +88,13 @@ class ValueTypeError(StructError):
                 repr(key), item_type.__name__, need_type.__name__)
         StructError.__init__(self, struct, msg)
 
+class FrozenError(NodeError, TypeError):
+    """The node belongs to a frozen tree and cannot be modified"""
+
+    def __init__(self, node):
+        msg = "Frozen %s cannot be modified" % node.__class__.__name__
+        NodeError.__init__(self, node, msg)
+
 class CoilParseError(CoilError):
     """General error during parsing"""
     pass
@@ -0,0 +1,116 @@
+# Copyright (c) 2008-2009 ITA Software, Inc.
+# See LICENSE.txt for details.
+
+"""Share a configuration tree that is replaced while being read."""
+
+import threading
+
+import coil
+from coil import struct
+
+
+class ConfigHandle(object):
+    """Holds the current root :class:`Struct <coil.struct.Struct>` of
+    a configuration that is reloaded while other threads read it.
+
+    Readers never lock: :meth:`snapshot` is a single attribute read
+    that returns a generation number and a root which always belong
+    together. A reader keeps using its root for as long as it likes,
+    for example for the rest of a request, and compares generations
+    to cheaply find out if a newer one has been published.
+
+    Writers build a complete new tree with :meth:`load` or
+    :meth:`merge` and swap it in with :meth:`publish`. Only writers
+    take a lock, and only to keep concurrent updates from losing one
+    another. Published trees are frozen with :meth:`Struct.freeze
+    <coil.struct.Struct.freeze>` so readers cannot modify them.
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: The initial configuration, an empty
+            :class:`Struct <coil.struct.Struct>` if not given.
+        :type root: :class:`Struct <coil.struct.Struct>`
+        """
+        if root is None:
+            root = struct.Struct()
+        self._lock = threading.Lock()
+        self._current = (0, root.freeze())
+
+    def snapshot(self):
+        """Get the current generation and root.
+
+        :return: (generation, root)
+        :rtype: *tuple*
+        """
+        return self._current
+
+    @property
+    def root(self):
+        """The current root :class:`Struct <coil.struct.Struct>`"""
+        return self._current[1]
+
+    @property
+    def generation(self):
+        """The number of times a new root has been published"""
+        return self._current[0]
+
+    def stale(self, generation):
+        """Check if a newer root was published since *generation*.
+
+        :param generation: A generation given by :meth:`snapshot`.
+        :type generation: *int*
+        :rtype: *bool*
+        """
+        return self._current[0] != generation
+
+    def publish(self, root):
+        """Freeze root and make it the current configuration.
+
+        :param root: The new configuration.
+        :type root: :class:`Struct <coil.struct.Struct>`
+        :return: The generation of root.
+        :rtype: *int*
+        """
+        root.freeze()
+        self._lock.acquire()
+        try:
+            generation = self._current[0] + 1
+            self._current = (generation, root)
+        finally:
+            self._lock.release()
+        return generation
+
+    def load(self, file_name, **kwargs):
+        """Parse a coil file with :func:`coil.parse_file` and publish
+        it. The current configuration stays in place if parsing fails.
+
+        :param file_name: Name of file to parse.
+        :type file_name: str
+        :return: The generation of the new root.
+        :rtype: *int*
+        """
+        return self.publish(coil.parse_file(file_name, **kwargs))
+
+    def merge(self, other):
+        """Publish a copy of the current configuration with other
+        merged into it, see :meth:`Struct.merge
+        <coil.struct.Struct.merge>`. Merges from several threads are
+        applied one after the other, none are lost.
+
+        :param other: The values to change.
+        :type other: :class:`Struct <coil.struct.Struct>` or *dict*
+        :return: The generation of the new root.
+        :rtype: *int*
+        """
+        self._lock.acquire()
+        try:
+            generation, root = self._current
+            root = root.copy()
+            root.merge(other)
+            root.freeze()
+            generation += 1
+            self._current = (generation, root)
+        finally:
+            self._lock.release()
+        return generation
@@ -17,18 +17,22 @@ class StructPrototype(struct.Struct):
     parse-time rather than run-time.
     """
 
-    def __init__(self, base=(), container=None, name=None, location=None):
+    def __init__(self, base=(), container=None, name=None, location=None,
+            weak_links=False):
         # Secondary items are ones that are inherited via @extends or @file
         # They must be tracked separately so we can raise errors on
         # double adds and deletes in the primary values.
+        # _secondary_order is used as an ordered set (values are None)
+        # so that lookups and removals stay cheap for very wide structs.
         self._secondary_values = {}
-        self._secondary_order = []
-        # _deleted is a list of items that exist in one of the parents
+        self._secondary_order = struct._OrderedMapping()
+        # _deleted is a set of items that exist in one of the parents
         # but have been removed from this Struct by ~foo tokens.
-        self._deleted = []
+        self._deleted = set()
 
         self._cls_struct = StructPrototype
-        super(StructPrototype, self).__init__(base, container, name, location)
+        super(StructPrototype, self).__init__(base, container, name, location,
+                weak_links)
 
     def _get(self, key):
         try:
@@ -36,6 +40,12 @@ class StructPrototype(struct.Struct):
         except KeyError:
             return self._secondary_values[key]
 
+    def _lookup(self, key):
+        value = super(StructPrototype, self)._lookup(key)
+        if value is struct._missing:
+            value = self._secondary_values.get(key, struct._missing)
+        return value
+
     def _set(self, key, value):
         self._validate_doubleset(key)
 
@@ -51,7 +61,7 @@ class StructPrototype(struct.Struct):
             super(StructPrototype, self)._del(key)
         except KeyError:
             del self._secondary_values[key]
-            self._secondary_order.remove(key)
+            del self._secondary_order[key]
         else:
             raise KeyError
 
@@ -103,11 +113,11 @@ class StructPrototype(struct.Struct):
                 value = new
             elif isinstance(value, struct.Node):
                 value = value.copy(self, key)
-            else:
-                raise Exception("Unexpected type %s" % type(value))
+            # Anything else is a plain immutable value
 
             self._secondary_values[key] = value
-            self._secondary_order.append(key)
+            self._secondary_order[key] = None
+            self._set_location(key, base.location(key))
 
     def _validate_doubleset(self, key):
         """Private: check that key has not been used (excluding parents)"""
@@ -127,29 +137,38 @@ class Parser(object):
     :param encoding: Read strings using the given encoding. All
         string values will be `unicode` objects rather than `str`.
     :param expand: Enables/disables expansion of the parsed tree.
+        Set to 'lazy' to expand items when they are first read
+        instead, see the lazy option of :meth:`struct.Struct.expand`.
     :param defaults: See :meth:`struct.Struct.expanditem`
     :param ignore_missing: See :meth:`struct.Struct.expanditem`
+    :param locations: Remember where each value was defined, see
+        :meth:`struct.Struct.location`. Off by default to save memory.
+    :param weak_links: See :class:`struct.Struct`
     """
 
     def __init__(self, input_, path=None, encoding=None,
-            expand=True, defaults=(), ignore_missing=()):
+            expand=True, defaults=(), ignore_missing=(), locations=False,
+            weak_links=False):
         if path:
             self._path = os.path.abspath(path)
         else:
             self._path = None
 
         self._encoding = encoding
+        self._locations = locations
         self._tokenizer = tokenizer.Tokenizer(input_, self._path, encoding)
 
         # Create the root Struct and parse!
-        self._prototype = StructPrototype()
+        self._prototype = StructPrototype(weak_links=weak_links)
 
         while self._tokenizer.peek('~', 'PATH', 'EOF').type != 'EOF':
             self._parse_attribute(self._prototype)
 
         self._tokenizer.next('EOF')
-        self._root = struct.Struct(self._prototype)
-        if expand:
+        self._root = struct.Struct(self._prototype, weak_links=weak_links)
+        if expand == 'lazy':
+            self._root.expand(defaults, ignore_missing, lazy=True)
+        elif expand:
             self._root.expand(defaults, ignore_missing)
 
     def root(self):
@@ -277,13 +296,19 @@ class Parser(object):
 
         token = self._tokenizer.next('PATH')
         link = struct.Link(token.value, container, name, token)
-        container.set(name, link, location=token)
+        container.set(name, link, location=self._location(token))
+
+    def _location(self, token):
+        if self._locations:
+            return token
+        else:
+            return None
 
     def _parse_plain(self, container, name):
         """number, string, bool, or None"""
 
         token = self._tokenizer.next('VALUE')
-        container.set(name, token.value, location=token)
+        container.set(name, token.value, location=self._location(token))
 
     def _special_extends(self, container, token):
         """Handle @extends: some.struct"""
@@ -316,7 +341,7 @@ class Parser(object):
 
         _container = container
         while _container is not None:
-            if _container == parent:
+            if _container is parent:
                 raise errors.StructError(container,
                       "@extends target cannot be parents of container")
             _container = _container.container
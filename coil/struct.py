@@ -10,12 +10,13 @@ as a tree and can handle relative references between them.
 
 from __future__ import generators
 
+import itertools
 import re
+import sys
+import threading
+import types
 import warnings
-try:
-    from collections import OrderedDict
-except ImportError:
-    from coil.ordereddict import OrderedDict
+import weakref
 
 from coil import tokenizer, errors
 
@@ -24,6 +25,19 @@ from coil import tokenizer, errors
 _EXPAND_BRACES = re.compile("^(.*){([^}]+)}(.*)$")
 _EXPAND_RANGE = re.compile("^(0*(\d+))\.\.(\d+)$")
 
+# Values which Struct stores as is rather than wrapped in a Leaf
+_SCALARS = (int, long, float)
+
+# Returned by Struct._lookup() and friends in place of a missing item
+# so that hot paths can test for it without raising an exception.
+_missing = object()
+
+# Infinite floats have no JSON literal, see _jsonitem()
+_INFINITY = float('inf')
+
+# Source of Struct.revision numbers, shared so none is ever reused
+_revisions = itertools.count(1)
+
 def _expand_str(string):
     """Helper function for _expand_list to operate on individual strings"""
 
@@ -61,21 +75,309 @@ def _expand_list(seq):
 
     return new
 
-def _copy_list(seq):
-    """Recursively copy a list of lists"""
+def _plain_list(seq, immutable=False):
+    """Recursively copy a :class:`List` or list of lists into plain
+    lists, or tuples if immutable is True. See :meth:`Struct.dict`."""
+
+    new = []
+    append = new.append
+    # The raw items of a List are all Nodes, mostly Leafs
+    for item in list.__iter__(seq):
+        if isinstance(item, Leaf):
+            item = item.leaf_value
+        elif isinstance(item, Struct):
+            item = item.dict(immutable)
+        elif isinstance(item, list):
+            item = _plain_list(item, immutable)
+        elif isinstance(item, Node):
+            item = item._pystd()
+        append(item)
+
+    if immutable:
+        return tuple(new)
+    else:
+        return new
+
+
+def _content_hash(value):
+    """Hash a value so values that compare equal hash the same"""
+
+    if isinstance(value, Struct):
+        return value.content_hash()
+    elif not isinstance(value, list):
+        return hash(value)
+
+    # The raw items of a List are all Nodes, mostly Leafs
+    hashes = []
+    append = hashes.append
+    for item in list.__iter__(value):
+        if isinstance(item, Leaf):
+            append(hash(item.leaf_value))
+        elif isinstance(item, (Struct, list)):
+            append(_content_hash(item))
+        else:
+            append(hash(item))
+    return hash(tuple(hashes))
+
+
+class _ReadOnlyDict(dict):
+    """Private: a dict which cannot be modified, see Struct.dict()"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%s objects are read-only" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def copy(self):
+        return dict(self)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+class _OrderedMapping(dict):
+    """Private: a dict which remembers the order keys were added in.
+
+    Iteration order follows the same rules as OrderedDict: setting an
+    existing key keeps its place and a deleted key that is set again
+    moves to the end. The order is kept in a plain list of keys which
+    costs far less memory than the linked list OrderedDict keeps per
+    key. A deleted key leaves a hole in the list that iteration skips,
+    the holes are only removed once they make up half of it so that
+    deleting is still cheap. Finding a key's place in the list takes a
+    map of positions which is only built once a key is deleted.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._order = []
+        # Position of each key in _order, None until a key is deleted.
+        self._slots = None
+        # Number of holes left in _order by deleted keys
+        self._holes = 0
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if not dict.__contains__(self, key):
+            slots = self._slots
+            if slots is not None:
+                slots[key] = len(self._order)
+            self._order.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        order = self._order
+        slots = self._slots
+        if slots is None:
+            slots = dict(itertools.izip(order, itertools.count()))
+            self._slots = slots
+        slot = slots.pop(key)
+        if slot == len(order) - 1:
+            # Holes are never left at the end of the list
+            order.pop()
+            while order and order[-1] is _missing:
+                order.pop()
+                self._holes -= 1
+        else:
+            order[slot] = _missing
+            self._holes += 1
+            if self._holes * 2 > len(order):
+                self._compact()
+
+    def _compact(self):
+        self._order = [key for key in self._order if key is not _missing]
+        self._slots = None
+        self._holes = 0
+
+    def __iter__(self):
+        if self._holes:
+            return (key for key in self._order if key is not _missing)
+        else:
+            return iter(self._order)
+
+    def __reversed__(self):
+        if self._holes:
+            return (key for key in reversed(self._order)
+                    if key is not _missing)
+        else:
+            return reversed(self._order)
+
+    def clear(self):
+        dict.clear(self)
+        self._order = []
+        self._slots = None
+        self._holes = 0
+
+    # Everything else is built on the methods above like DictMixin
+    # does. Values are read with self[key] so subclasses see them.
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield (key, self[key])
+
+    def keys(self):
+        return list(self)
 
-    def copy_items(seq):
-        for item in seq:
-            if isinstance(item, list):
-                yield list(copy_items(item))
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for key in other.keys():
+                    self[key] = other[key]
             else:
-                yield item
+                for key, value in other:
+                    self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    _marker = object()
+
+    def pop(self, key, default=_marker):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is self._marker:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+        if last:
+            key = reversed(self).next()
+        else:
+            key = iter(self).next()
+        return key, self.pop(key)
 
-    return list(copy_items(seq))
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+        return default
 
 
-class _Ignore(Exception):
-    """Special exception to signal that a value should not be expanded"""
+class Path(tuple):
+    """A compiled path as accepted by :meth:`Struct.get` and friends.
+
+    The first item is the number of containers to go up before
+    following the remaining keys or *None* if the path starts at
+    ``@root``. The keys are interned so comparing them is cheap.
+    Use :meth:`compile` to create paths, it remembers the most
+    recently used ones so each path string is parsed only once.
+    """
+
+    __slots__ = ()
+
+    #: Number of compiled paths kept by :meth:`compile`
+    cache_size = 1024
+
+    # The cache is split in two generations, when the recent one is
+    # full the older one is dropped. Anything used since is promoted.
+    _recent = {}
+    _older = {}
+
+    def __new__(cls, depth, keys=()):
+        """
+        :param depth: containers to go up, *None* for ``@root``.
+        :type depth: int
+        :param keys: the names to follow from there.
+        """
+        return tuple.__new__(cls, (depth,) + tuple(map(_intern, keys)))
+
+    @classmethod
+    def compile(cls, path):
+        """Get the compiled form of a path string.
+
+        :param path: path to compile, a :class:`Path` is returned as is.
+        :type path: str
+        :rtype: :class:`Path`
+        """
+
+        if isinstance(path, Path):
+            return path
+
+        compiled = Path._recent.get(path)
+        if compiled is None:
+            compiled = Path._older.get(path)
+            if compiled is None:
+                compiled = cls._parse(path)
+            if len(Path._recent) >= Path.cache_size:
+                Path._older = Path._recent
+                Path._recent = {}
+            Path._recent[path] = compiled
+
+        return compiled
+
+    @classmethod
+    def _parse(cls, path):
+        if path.startswith("@root"):
+            names = path[5:]
+            if names.startswith(".") and not names.startswith(".."):
+                names = names[1:]
+            elif names:
+                raise ValueError("Invalid path %r" % path)
+            depth = None
+        else:
+            names = path.lstrip('.')
+            depth = max(len(path) - len(names) - 1, 0)
+
+        # mid-path parent references are not allowed
+        if ".." in names:
+            raise ValueError("Invalid path %r" % path)
+
+        if names:
+            return cls(depth, names.split('.'))
+        else:
+            return cls(depth)
+
+    @property
+    def depth(self):
+        """Containers to go up, *None* if the path is absolute."""
+        return self[0]
+
+    @property
+    def keys(self):
+        """The names to follow."""
+        return self[1:]
+
+    def __str__(self):
+        names = ".".join(self[1:])
+        if self[0] is None:
+            if names:
+                return "@root.%s" % names
+            else:
+                return "@root"
+        elif self[0]:
+            return "." * (self[0] + 1) + names
+        else:
+            return names
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, str(self))
+
+
+def _intern(key):
+    # intern() only accepts str
+    if type(key) is str:
+        return intern(key)
+    return key
 
 
 class Node(tokenizer.Location):
@@ -85,14 +387,21 @@ class Node(tokenizer.Location):
     PATH = re.compile(r'^%s$' % tokenizer.Tokenizer.PATH_REGEX)
     EXPAND = re.compile(r'\$\{(%s)\}' % tokenizer.Tokenizer.PATH_REGEX)
 
-    #: The parent node in the coil tree
-    container = None
+    # The parent node, or a weak reference to it. See container.
+    _container = None
     #: The name of this node inside container
     node_name = None
-    #: The absolute path of this node in the coil tree
-    node_path = None
-    #: The root node of the coil tree
-    tree_root = None
+    # Set on Structs whose children should only hold weak references
+    # to them, see the weak_links option of Struct.
+    _weak_links = False
+    # Called when a weakly referenced container is freed
+    _container_lost = None
+    # A weak reference to the node this one was copied from, if any,
+    # and to the root of its tree at the time for when it is gone.
+    _orig = None
+    _orig_root = None
+    # Set on the Structs and Lists of a tree by Struct.freeze()
+    _frozen = False
 
     # Node classes should access others through these attributes,
     # otherwise users would have trouble with subclasses. The actual
@@ -115,33 +424,93 @@ class Node(tokenizer.Location):
         self._set_container(container, name)
 
         # For paths we must know their original context in order
-        # to copy them to new parts of the tree properly.
+        # to copy them to new parts of the tree properly. The
+        # reference is weak so copies don't keep the original alive.
         if isinstance(value, Node):
-            self._orig = value._orig
+            if value._orig is None:
+                self._orig = weakref.ref(value)
+                self._orig_root = weakref.ref(value.tree_root)
+            else:
+                self._orig = value._orig
+                self._orig_root = value._orig_root
+
+    def _original_root(self):
+        """Get the root of the tree the node this one was originally
+        copied from is in, *None* if that tree no longer exists."""
+        if self._orig is None:
+            return self.tree_root
+        orig = self._orig()
+        if orig is not None:
+            return orig.tree_root
+        else:
+            return self._orig_root()
+
+    @property
+    def container(self):
+        """The parent node in the coil tree"""
+        container = self._container
+        if type(container) is weakref.ref:
+            return container()
         else:
-            self._orig = self
+            return container
 
     def _set_container(self, container, name):
         if self.container is not None and self.container is container:
             pass
         elif container is not None and name:
             # Sanity check that container is valid
-            assert container.tree_root is not None
             assert container.node_name
-            assert container.node_path
-            self.container = container
+            if container._weak_links:
+                self._container = weakref.ref(container,
+                        self._container_lost)
+            else:
+                self._container = container
             self.node_name = name
-            self.node_path = "%s.%s" % (container.node_path, name)
-            self.tree_root = container.tree_root
         elif container is None:
             assert name is None or name == "@root"
-            self.container = None
+            self._container = None
             self.node_name = "@root"
-            self.node_path = "@root"
-            self.tree_root = self
         else:
             assert 0
 
+    @property
+    def frozen(self):
+        """*True* if this node belongs to a tree made immutable
+        by :meth:`Struct.freeze`"""
+        return self._frozen
+
+    def _check_frozen(self):
+        """Called before this Node is modified in place"""
+        if self._frozen:
+            raise errors.FrozenError(self)
+
+    def _changed(self):
+        """Called whenever this Node is modified in place"""
+        container = self.container
+        if container is not None:
+            container._changed()
+
+    # The path and root are derived from the container so that moving
+    # a node never has to update anything below it.
+
+    @property
+    def node_path(self):
+        """The absolute path of this node in the coil tree"""
+        container = self.container
+        if container is None:
+            return "@root"
+        else:
+            return "%s.%s" % (container.node_path, self.node_name)
+
+    @property
+    def tree_root(self):
+        """The root node of the coil tree"""
+        container = self.container
+        if container is None:
+            return self
+        else:
+            return container.tree_root
+
     @classmethod
     def validate_key(cls, key):
         """Check if the given key is valid.
@@ -214,6 +583,8 @@ class Node(tokenizer.Location):
         :rtype: str
         """
 
+        if isinstance(path, Path):
+            path = str(path)
         if path.startswith("@root"):
             return path
         if ref is None:
@@ -223,19 +594,19 @@ class Node(tokenizer.Location):
 
         names = path.lstrip('.')
         dots = len(path) - len(names)
-        split = ref.split('.')
 
-        if dots > len(split):
+        if dots > ref.count('.') + 1:
             msg = "Reference past root node in %r" % path
             if ref != self.node_path:
                 msg = "%s (ref=%r)" % (msg, ref)
             raise errors.NodeError(self, msg)
 
         if dots > 1:
-            split = split[:-dots+1]
+            ref = ref.rsplit('.', dots - 1)[0]
         if names:
-            split.append(names)
-        return ".".join(split)
+            return "%s.%s" % (ref, names)
+        else:
+            return ref
 
     def _translate_path(self, old_path, old_node):
         """Helper method for translating absolute paths between trees.
@@ -252,8 +623,8 @@ class Node(tokenizer.Location):
         not changed because @root does refer to the same thing so the
         relative path is exactly the wrong thing to look at.
         """
-        if (old_node._orig.tree_root is not self.tree_root and
-                old_path.startswith("@root")):
+        if (old_path.startswith("@root") and
+                old_node._original_root() is not self.tree_root):
             rel_path = old_node.container.relative_path(old_path)
             new_path = self.container.absolute_path(rel_path)
             return new_path
@@ -286,48 +657,7 @@ class Node(tokenizer.Location):
             :exc:`~errors.KeyMissingError`.
         :type ignore_missing: :class:`bool` or container
         """
-        self._expand(defaults, ignore_missing, recursive, set())
-
-    def _expand(self, defaults, ignore_missing, recursive, block):
-        """Internal method implementing :meth:`expand`.
-
-        Note: when calling this function recursively always duplciate
-
-        :param block: a set of absolute paths that cannot be expanded.
-                      This is used to detect any circular references.
-                      When calling recursively always pass a new object.
-        :type block: :class:`set`
-        """
-
-        if self.node_path in block:
-            raise errors.CircularReference(self, self.node_path)
-        elif self.node_name != "+list+":
-            # Lists are special right now since the nodes
-            # inside them don't have paths.
-            block.add(self.node_path)
-
-    def _fetch(self, path, ref, defaults, ignore_missing, block):
-        """Helper method for :meth:`_expand` for getting values.
-        This implements the magic of defaults and ignore_missing.
-        """
-
-        path = ref.absolute_path(path)
-        if path in block:
-            raise errors.CircularReference(self, path)
-
-        try:
-            return ref.get(path)
-        except KeyError:
-            base = path.rsplit('.', 1)[-1]
-
-            if path in defaults:
-                return defaults[path]
-            elif base in defaults:
-                return defaults[base]
-            elif path in ignore_missing or base in ignore_missing:
-                raise _Ignore()
-            else:
-                raise
+        _Expander(defaults, ignore_missing).expand(self)
 
     def _wrap(self, key, value, container=None):
         """Helper for wrapping/copying values when adding them"""
@@ -336,6 +666,9 @@ class Node(tokenizer.Location):
             container = self
 
         if isinstance(value, Node):
+            if value._frozen or getattr(value.container, '_frozen', False):
+                # Nodes of a frozen tree must stay where they are
+                return value.copy(container, key)
             value._set_container(container, key)
             return value
         elif isinstance(value, dict):
@@ -370,32 +703,76 @@ class Leaf(Node):
         assert container is not None and name
         super(Leaf, self).__init__(value, container, name, location)
 
-        def translate(match):
-            return "${%s}" % self._translate_path(match.group(1), value)
-
-        def verify(match):
-            container.absolute_path(match.group(1))
-
         if isinstance(value, Leaf):
-            if value._is_string:
-                self._is_string = True
-                self.leaf_value = self.EXPAND.sub(
-                        translate, value.leaf_value)
-            else:
-                self._is_string = False
-                self.leaf_value = value.leaf_value
+            self._is_string = value._is_string
+            self.leaf_value = value.leaf_value
+            self._template = value._template
+            # Paths only need translating when moving between trees
+            if (self._template is not None and
+                    value._original_root() is not self.tree_root):
+                template = list(self._template)
+                for i in xrange(1, len(template), 2):
+                    template[i] = self._translate_path(template[i], value)
+                self._template = tuple(template)
+                self.leaf_value = self._render(self._template)
         else:
             if isinstance(value, basestring):
                 self._is_string = True
                 self.leaf_value = value
+                self._template = self._compile(value)
                 # Check that any links don't pass @root
-                self.EXPAND.sub(verify, value)
+                if self._template is not None:
+                    for i in xrange(1, len(self._template), 2):
+                        container.absolute_path(self._template[i])
             elif value is None or isinstance(value, (int, long, float)):
                 self._is_string = False
                 self.leaf_value = value
+                self._template = None
             else:
                 raise TypeError("Invalid value type: %s" % type(value))
 
+    @classmethod
+    def _compile(cls, value):
+        """Split a string into literal text and sub-string variables.
+
+        Returns None if there is nothing to expand, otherwise a tuple
+        of literal text and paths alternating, beginning and ending
+        with (possibly empty) literal text.
+        """
+
+        if "${" not in value:
+            return None
+
+        template = []
+        start = 0
+        for match in cls.EXPAND.finditer(value):
+            template.append(value[start:match.start()])
+            template.append(match.group(1))
+            start = match.end()
+
+        if not template:
+            return None
+
+        template.append(value[start:])
+        return tuple(template)
+
+    @staticmethod
+    def _render(template):
+        """Convert a template from :meth:`_compile` back to a string"""
+
+        parts = list(template)
+        for i in xrange(1, len(parts), 2):
+            parts[i] = "${%s}" % parts[i]
+        return "".join(parts)
+
+    def _update(self, value, changed=True):
+        """Replace the string value of this Leaf, used by expansion"""
+
+        self.leaf_value = value
+        self._template = self._compile(value)
+        if changed:
+            self._changed()
+
     @staticmethod
     def __other(other):
         if isinstance(other, Leaf):
@@ -424,22 +801,6 @@ class Leaf(Node):
     def _pystd(self):
         return self.leaf_value
 
-    def _expand(self, defaults, ignore_missing, recursive, block):
-        if not self._is_string:
-            return
-
-        if isinstance(self.leaf_value, unicode):
-            strcls = unicode
-        else:
-            strcls = str
-
-        def getpath(match):
-            return strcls(self._fetch(match.group(1), self.container,
-                                      defaults, ignore_missing, block))
-
-        super(Leaf, self)._expand(defaults, ignore_missing, recursive, block)
-        self.leaf_value = self.EXPAND.sub(getpath, self.leaf_value)
-
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.leaf_value)
 
@@ -505,12 +866,44 @@ class List(Node, list):
         """
         list.__init__(self)
         Node.__init__(self, sequence, container, name, location)
-        self.extend(sequence)
+        # Containers are told about a new List once it is set in one
+        list.extend(self, self._copy_items(sequence))
 
     # Raw get/set/del functions
     _get = list.__getitem__
-    _set = list.__setitem__
-    _del = list.__delitem__
+
+    def _set(self, index, value):
+        self._check_frozen()
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def _del(self, index):
+        self._check_frozen()
+        list.__delitem__(self, index)
+        self._changed()
+
+    __delitem__ = _del
+
+    def __setslice__(self, i, j, sequence):
+        self._check_frozen()
+        list.__setslice__(self, i, j,
+                [self._wrap('+list+', x) for x in sequence])
+        self._changed()
+
+    def __delslice__(self, i, j):
+        self._check_frozen()
+        list.__delslice__(self, i, j)
+        self._changed()
+
+    def __iadd__(self, sequence):
+        self.extend(sequence)
+        return self
+
+    def __imul__(self, count):
+        self._check_frozen()
+        list.__imul__(self, count)
+        self._changed()
+        return self
 
     def _wrap(self, key, value, container=None):
         # container self.container instead of self
@@ -526,71 +919,192 @@ class List(Node, list):
             return value
 
     def pop(self, index):
+        self._check_frozen()
         value = list.pop(self, index)
+        self._changed()
         if isinstance(value, Leaf):
             return value.leaf_value
         else:
             return value
 
     def __setitem__(self, index, value):
+        self._check_frozen()
         self._set(index, self._wrap('+list+', value))
 
     def append(self, value):
+        self._check_frozen()
         list.append(self, self._wrap('+list+', value))
+        self._changed()
 
     def insert(self, index, value):
+        self._check_frozen()
         list.insert(self, index, self._wrap('+list+', value))
+        self._changed()
+
+    def remove(self, value):
+        self._check_frozen()
+        list.remove(self, value)
+        self._changed()
+
+    def reverse(self):
+        self._check_frozen()
+        list.reverse(self)
+        self._changed()
+
+    def sort(self, *args, **kwargs):
+        self._check_frozen()
+        list.sort(self, *args, **kwargs)
+        self._changed()
 
     def extend(self, sequence):
+        self._check_frozen()
+        list.extend(self, self._copy_items(sequence))
+        self._changed()
+
+    def _copy_items(self, sequence):
+        """Generate copies of the items in sequence to add to this
+        :class:`List`"""
         if isinstance(sequence, List):
-            def copy_items():
-                """Copy items from another List"""
-                for i in xrange(len(sequence)):
-                    item = sequence._get(i)
-                    yield item.copy(self.container, '+list+')
+            container = self.container
+            for i in xrange(len(sequence)):
+                yield sequence._get(i).copy(container, '+list+')
         else:
-            def copy_items():
-                """Copy items from anything else"""
-                for x in sequence:
-                    yield self._wrap('+list+', x)
-
-        list.extend(self, copy_items())
+            for x in sequence:
+                yield self._wrap('+list+', x)
 
     def __iter__(self):
         for i in xrange(len(self)):
             yield self[i]
 
-    def list(self):
-        """Recursively copy this :class:`List` into :class:`list` objects"""
+    def content_hash(self):
+        """Get a hash of the items in this :class:`List`, see
+        :meth:`Struct.content_hash`. Lists are usually short so
+        unlike Structs the hash is not cached."""
 
-        def copy_items():
-            for i in xrange(len(self)):
-                item = self._get(i)
-                yield item._pystd()
+        return _content_hash(self)
 
-        return list(copy_items())
+    def __hash__(self):
+        if not self._frozen:
+            raise TypeError("unhashable type: '%s'" % self.__class__.__name__)
+        return _content_hash(self)
 
-    _pystd = list
+    def list(self, immutable=False):
+        """Recursively copy this :class:`List` into :class:`list` objects
 
-    def _expand(self, defaults, ignore_missing, block):
-        super(List, self)._expand(defaults, ignore_missing, block)
-        for i in xrange(len(self)):
-            item = self._get(i)
-            item._expand(defaults, ignore_missing, set(block))
+        :param immutable: Copy into tuples and read-only dicts instead,
+            see :meth:`Struct.dict`.
+        :type immutable: *bool*
+        """
+
+        return _plain_list(self, immutable)
+
+    _pystd = list
 
     def __repr__(self):
         return "%s(%s)" % (self.__class__.__name__, list.__repr__(self))
 
 
-class Struct(Node, OrderedDict):
+def _stritem(node, item):
+    """Format a value in the coil text format"""
+
+    # FIXME: unicode breaks this, we need to handle encodings
+    # explicitly in Structs rather than just in Parser
+    if isinstance(item, basestring):
+        # Should we use """ for multi-line strings?
+        item = item.replace('\\', '\\\\')
+        item = item.replace('\n', '\\n')
+        item = item.replace('\r', '\\r')
+        item = item.replace('"', '\\"')
+        return '"%s"' % item
+    elif isinstance(item, (list, tuple)):
+        return "[%s]" % " ".join([_stritem(node, x) for x in item])
+    elif (isinstance(item, (int, long, float)) or
+            item in (True, False, None)):
+        return str(item)
+    else:
+        raise errors.StructError(node,
+            "%s cannot be represented in the coil text format" % item)
+
+
+def _jsonitem(node, item, encode):
+    """Format a value as JSON, strings are formatted with encode"""
+
+    if isinstance(item, basestring):
+        return encode(item)
+    elif item is None:
+        return "null"
+    elif item is True:
+        return "true"
+    elif item is False:
+        return "false"
+    elif isinstance(item, (int, long)):
+        return str(item)
+    elif isinstance(item, float):
+        if item != item:
+            return "NaN"
+        elif item == _INFINITY:
+            return "Infinity"
+        elif item == -_INFINITY:
+            return "-Infinity"
+        else:
+            return repr(item)
+    elif isinstance(item, Struct):
+        return "".join(item.iterjson())
+    elif isinstance(item, (list, tuple)):
+        return "[%s]" % ", ".join([_jsonitem(node, x, encode) for x in item])
+    else:
+        raise errors.StructError(node,
+            "%s cannot be represented as JSON" % item)
+
+
+def _write_chunks(fileobj, chunks, size=1024):
+    """Write an iterable of strings to a file, joining them into
+    batches of the given number of chunks to cut down on calls."""
+
+    write = fileobj.write
+    batch = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= size:
+            write("".join(batch))
+            del batch[:]
+    if batch:
+        write("".join(batch))
+
+
+class Struct(Node, _OrderedMapping):
     """A dict-like object for use in trees."""
 
     #: Signal :meth:`get` to raise an error if key is not found
     _raise = object()
     #: Signal :meth:`set` to preserve location data for key
     keep = object()
-
-    def __init__(self, base=(), container=None, name=None, location=None):
+    #: The expansion engine of a tree being expanded lazily,
+    #: only set on the root :class:`Struct` of the tree.
+    _expander = None
+    #: Absolute paths of the Structs in a tree, see :meth:`use_index`.
+    #: Only set on the root :class:`Struct` of the tree.
+    _index = None
+    # Where each item was defined by key, see location(). Only
+    # created once a location is given to set().
+    _locations = None
+    # Structs cache their (generation, node_path, tree_root), the
+    # cache is valid as long as no Struct is moved to a new place.
+    _located = None
+    _generation = 0
+    # Cached content_hash(), cleared along with that of every
+    # container above when this Struct changes. When unset here
+    # it is also unset in all of the containers above.
+    _hash = None
+    # See revision, updated along with _hash.
+    _revision = 0
+    # Set while _extend() is adding items
+    _extending = False
+    # The result of dict(immutable=True) as (revision, result)
+    _readonly = None
+
+    def __init__(self, base=(), container=None, name=None, location=None,
+            weak_links=False):
         """
         :param base: A *dict*, *Struct*, or a sequence of (key, value)
             tuples to initialize with. Any child *dict* or *Struct*
@@ -600,19 +1114,80 @@ class Struct(Node, OrderedDict):
         :param location: The where this *Struct* is defined.
             This is normally only used by the :class:`Parser
             <coil.parser.Parser>`.
+        :param weak_links: Nodes only keep a weak reference to their
+            container so the tree has no reference cycles and is
+            freed as soon as the last reference to its root is gone,
+            without waiting for the garbage collector. The catch is
+            that a child of a freed tree becomes a root itself. This
+            is inherited by child Structs and copies of this one.
+        :type weak_links: *bool*
         """
-        OrderedDict.__init__(self)
+        _OrderedMapping.__init__(self)
         Node.__init__(self, base, container, name, location)
 
+        if (weak_links or getattr(base, '_weak_links', False) or
+                (container is not None and container._weak_links)):
+            self._weak_links = True
+
         # the list of child structs if this is a map, this map
         # copy kludge probably can go away when StructPrototype does.
         self._map = getattr(base, '_map', None)
-        self._extend(base)
+        if base:
+            # Containers are told about a new Struct once it is set
+            # in one, not while it is being filled in.
+            self._extend(base, changed=False)
+        self._revision = _revisions.next()
+
+    # Raw get/set/del functions. Numbers, booleans, None and strings
+    # without sub-string variables are stored as is, everything else
+    # is wrapped in a Node. See _wrap().
+    _get = dict.__getitem__
+
+    def _set(self, key, value):
+        if self._frozen:
+            raise errors.FrozenError(self)
+        _OrderedMapping.__setitem__(self, key, value)
+        if not self._extending:
+            self._changed()
+
+    def _del(self, key):
+        if self._frozen:
+            raise errors.FrozenError(self)
+        _OrderedMapping.__delitem__(self, key)
+        self._changed()
+
+    def clear(self):
+        self._check_frozen()
+        if self.tree_root._index is not None:
+            for key in self:
+                self._unindex(key)
+        _OrderedMapping.clear(self)
+        self._changed()
+        self._forget()
+
+    def _changed(self):
+        revision = _revisions.next()
+        node = self
+        while node is not None:
+            node._revision = revision
+            node._hash = None
+            node = node.container
 
-    # Raw get/set/del functions
-    _get = OrderedDict.__getitem__
-    _set = OrderedDict.__setitem__
-    _del = OrderedDict.__delitem__
+    @property
+    def revision(self):
+        """A number which changes whenever this :class:`Struct` or
+        anything below it is modified, including by :meth:`expand`.
+        Numbers are taken from a counter shared by all Structs so they
+        only ever increase and a Struct that replaces another never
+        has a revision the old one had. Caches derived from part of a
+        tree can remember its revision and compare it later to tell
+        if they are still valid.
+        """
+        return self._revision
+
+    def _lookup(self, key):
+        """Raw get returning :data:`_missing` instead of raising."""
+        return dict.get(self, key, _missing)
 
     # 3.x compat
     @property
@@ -623,17 +1198,52 @@ class Struct(Node, OrderedDict):
     def _path(self):
         return self.node_path
 
+    @staticmethod
+    def _container_lost(ref):
+        # Cached paths below a freed container are no longer valid
+        Struct._generation += 1
+
     def _set_container(self, container, name):
+        # A new Struct has no children which may have cached paths
+        moved = self.node_name is not None and self.container is not container
         super(Struct, self)._set_container(container, name)
-        if container is not None:
-            self._update_path()
+        if moved:
+            Struct._generation += 1
 
-    def _update_path(self):
-        assert self.container is not None
-        self.node_path = "%s.%s" % (self.container.node_path, self.node_name)
-        for node in self.itervalues():
-            if isinstance(node, Struct):
-                node._update_path()
+    def _locate(self):
+        located = self._located
+        if located is None or located[0] != Struct._generation:
+            container = self.container
+            if container is None:
+                located = (Struct._generation, "@root", None)
+            else:
+                # The root is referenced weakly to avoid a cycle
+                parent = container._locate()
+                root = parent[2]
+                if root is None:
+                    root = weakref.ref(container)
+                located = (Struct._generation,
+                        "%s.%s" % (parent[1], self.node_name), root)
+            self._located = located
+        return located
+
+    @property
+    def node_path(self):
+        """The absolute path of this node in the coil tree"""
+        return self._locate()[1]
+
+    @property
+    def tree_root(self):
+        """The root node of the coil tree"""
+        root = self._locate()[2]
+        if root is None:
+            return self
+        root = root()
+        if root is None:
+            # Freed with weak_links, find the new root
+            self._located = None
+            return self.tree_root
+        return root
 
     def get(self, path, default=_raise):
         """Get a value from any :class:`Struct` in the tree.
@@ -648,34 +1258,62 @@ class Struct(Node, OrderedDict):
         :return: The fetched item or the value of *default*.
         """
 
-        try:
-            parent, key = self._get_next_parent(path)
-        except KeyError:
-            if default is self._raise:
-                raise
-            else:
-                return default
+        # Missing items are signaled with _missing internally, only
+        # the caller gets to see a KeyMissingError.
+        missing = default is not self._raise
+        parent, key = self._get_next_parent(path, missing=missing)
+        if parent is None:
+            return default
 
         if parent is self:
             if not key:
                 value = self
             else:
-                try:
-                    value = self._get(key)
-                    if isinstance(value, Leaf):
-                        value = value.leaf_value
-                except KeyError:
+                value = self._lookup(key)
+                if value is _missing:
                     if default is self._raise:
                         raise errors.KeyMissingError(self, key)
                     else:
-                        value = default
+                        return default
+
+                if isinstance(value, Node) and not isinstance(value, Struct):
+                    value = self._unwrap(value)
         else:
             value = parent.get(key, default)
 
         return value
 
+    def _unwrap(self, node):
+        """Get the value of a Node other than a Struct held by this
+        Struct, expanding it first if the tree is expanded lazily."""
+
+        if isinstance(node, Leaf) and node._template is None:
+            return node.leaf_value
+
+        expander = self.tree_root._expander
+        if expander is not None:
+            return expander.evaluate(node)
+        elif isinstance(node, Leaf):
+            return node.leaf_value
+        else:
+            return node
+
     __getitem__ = get
 
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def iteritems(self):
+        # Plain values and Structs are what get() would return
+        # anyway, only other Nodes need to be unwrapped.
+        get = self._get
+        for key in self:
+            value = get(key)
+            if isinstance(value, Node) and not isinstance(value, Struct):
+                value = self._unwrap(value)
+            yield key, value
+
     def set(self, path, value, location=None):
         """Set a value in any :class:`Struct` in the tree.
 
@@ -686,32 +1324,138 @@ class Struct(Node, OrderedDict):
             is already set, this is used by :meth:`expanditem`.
         """
 
+        # Before value is wrapped, which may move it into this tree
+        self._check_frozen()
         parent, key = self._get_next_parent(path, True)
 
         if parent is self:
             if not key or not self.KEY.match(key):
                 raise errors.KeyValueError(self, key)
 
+            self._unindex(key)
             self._set(key, self._wrap(key, value))
+            if location is not self.keep:
+                self._set_location(key, location)
+            self._forget()
         else:
             parent.set(key, value, location)
 
     __setitem__ = set
 
     def __delitem__(self, path):
+        self._check_frozen()
         parent, key = self._get_next_parent(path)
 
         if parent is self:
             if not key:
                 raise errors.KeyValueError(path)
 
+            self._unindex(key)
             try:
-                self._del(path)
+                self._del(key)
             except KeyError:
                 raise errors.KeyMissingError(self, key)
+            self._set_location(key, None)
+            self._forget()
         else:
             del parent[key]
 
+    def _wrap(self, key, value, container=None):
+        # Plain values are stored as is, only wrap what needs it.
+        if isinstance(value, Leaf) and value._template is None:
+            return value.leaf_value
+        elif value is None or isinstance(value, _SCALARS):
+            return value
+        elif isinstance(value, basestring) and "${" not in value:
+            return value
+        else:
+            return super(Struct, self)._wrap(key, value, container)
+
+    def location(self, key):
+        """Get where an item of this :class:`Struct` was defined.
+
+        :param key: name of the item.
+        :return: The location given to :meth:`set` or *None*
+        :rtype: :class:`Location <coil.tokenizer.Location>`
+        """
+
+        if self._locations is None:
+            return None
+        else:
+            return self._locations.get(key)
+
+    def _set_location(self, key, location):
+        if location is not None:
+            if self._locations is None:
+                self._locations = {}
+            self._locations[key] = tokenizer.Location(location)
+        elif self._locations is not None:
+            self._locations.pop(key, None)
+
+    def _forget(self):
+        """Drop anything a lazy expansion remembers about this tree"""
+
+        expander = self.tree_root._expander
+        if expander is not None:
+            expander.forget()
+
+    def use_index(self, enable=True):
+        """Keep an index of the absolute paths of all :class:`Struct`
+        objects in this tree so that reading a deep path from any node
+        costs a single hash lookup rather than one :meth:`get` per
+        component. The index is filled in as paths are read and kept
+        up to date by :meth:`set`, del, :meth:`update`, and
+        :meth:`merge`. Best suited for trees which are read far more
+        often than they are modified. Only allowed on the root of a
+        tree.
+
+        :param enable: Set to *False* to drop the index.
+        :type enable: *bool*
+        """
+
+        if self.container is not None:
+            raise errors.StructError(self,
+                "The path index must be set on the root Struct")
+
+        if enable:
+            if self._index is None:
+                self._index = {}
+        else:
+            self._index = None
+
+    def _unindex(self, key):
+        """Drop the index entries of a Struct about to be replaced."""
+
+        index = self.tree_root._index
+        if index is None:
+            return
+
+        node = self._lookup(key)
+        if isinstance(node, Struct):
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                index.pop(node.node_path, None)
+                for child_key in node:
+                    child = node._get(child_key)
+                    if isinstance(child, Struct):
+                        stack.append(child)
+
+    def get_many(self, paths, default=_raise):
+        """Get the values of several paths at once. Uses the path
+        index if it is enabled, see :meth:`use_index`.
+
+        :param paths: keys or arbitrary paths to fetch.
+        :param default: return this value for missing items,
+            see :meth:`get`.
+
+        :return: The fetched items in the same order as paths.
+        :rtype: *list*
+        """
+
+        get = self.get
+        return [get(path, default) for path in paths]
+
     def _rawitems(self):
         for k in self:
             yield k, self._get(k)
@@ -731,7 +1475,7 @@ class Struct(Node, OrderedDict):
         """
         self._extend(other, recursive=True)
 
-    def _extend(self, other, recursive=False):
+    def _extend(self, other, recursive=False, changed=True):
         """Helper for update(), and merge()"""
 
         def setitem(key, value):
@@ -742,25 +1486,43 @@ class Struct(Node, OrderedDict):
                     current._extend(value, recursive=True)
                     return
 
+            self._unindex(key)
             if isinstance(value, Struct):
                 self._set(key, self.__class__(value, self, key, value))
-            elif isinstance(value, Node):
+            elif isinstance(value, Node) and not (isinstance(value, Leaf)
+                    and value._template is None):
                 self._set(key, value.copy(self, key))
             else:
                 self._set(key, self._wrap(key, value))
 
-        if isinstance(other, Struct):
-            for key, value in other._rawitems():
-                setitem(key, value)
-        elif hasattr(other, 'iteritems'):
-            for key, value in other.iteritems():
-                setitem(key, value)
-        elif hasattr(other, 'keys'):
-            for key in other.keys():
-                setitem(key, other[key])
-        else:
-            for key, value in other:
-                setitem(key, value)
+        # The containers above are told about the change once
+        # rather than for every item.
+        self._check_frozen()
+        self._extending = True
+        try:
+            if isinstance(other, Struct):
+                # A lazily expanded tree must be expanded as it is
+                # copied, the copy has no expander of its own.
+                lazy = other.tree_root._expander is not None
+                for key, value in other._rawitems():
+                    if (lazy and isinstance(value, Node) and
+                            not isinstance(value, Struct)):
+                        value = other._unwrap(value)
+                    setitem(key, value)
+                    self._set_location(key, other.location(key))
+            elif hasattr(other, 'iteritems'):
+                for key, value in other.iteritems():
+                    setitem(key, value)
+            elif hasattr(other, 'keys'):
+                for key in other.keys():
+                    setitem(key, other[key])
+            else:
+                for key, value in other:
+                    setitem(key, value)
+        finally:
+            del self._extending
+            if changed:
+                self._changed()
 
     def attributes(self):
         """Alias for :meth:`keys`.
@@ -769,7 +1531,8 @@ class Struct(Node, OrderedDict):
         """
         return self.keys()
 
-    def expand(self, defaults=(), ignore_missing=(), recursive=True, _block=()):
+    def expand(self, defaults=(), ignore_missing=(), recursive=True,
+            stats=None, lazy=False, paths=None):
         """Expand all :class:`Link` and sub-string variables in this
         and, if recursion is enabled, all child :class:`Struct`
         objects. This is normally called during parsing but may be
@@ -781,62 +1544,65 @@ class Struct(Node, OrderedDict):
         :param ignore_missing: :meth:`expandvalue`
         :param recursive: recursively expand sub-structs
         :type recursive: *bool*
-        :param _block: See :meth:`expandvalue`
+        :param stats: if a *dict* is given it is updated with the
+            number of references that were resolved from the memo
+            table ('hits'), searched for in the tree ('misses'), and
+            the resulting 'hit_rate'.
+        :type stats: *dict*
+        :param lazy: Rather than expanding everything now, expand
+            each item the first time it is read with :meth:`get`.
+            Only @map is applied immediately since it changes which
+            keys exist. Errors are raised by :meth:`get` rather than
+            here, use :meth:`expandall` to expand everything that is
+            left. Only allowed on the root of a tree. The tree may be
+            read from several threads, expanding an item on read is
+            not counted as a change to the tree's :attr:`revision`.
+        :type lazy: *bool*
+        :param paths: Only expand the items at these paths and
+            whatever they depend on (links, sub-string variables, and
+            @map inputs) rather than everything. A path to a
+            :class:`Struct` expands all of it.
+        :type paths: list of paths relative to this :class:`Struct`
         """
 
-        abspath = self.path()
-        if abspath in _block:
-            raise errors.StructError(self, "Circular reference to %s" % abspath)
-
-        _block = list(_block)
-        _block.append(abspath)
-
-        if self._map is not None:
-            map = _expand_list(self._map)
-            self._map = None
-            structs = []
-            lists = []
-
-            # We don't use iter because this loop delete stuff
-            for key in self.keys():
-                value = self.expanditem(key, defaults, ignore_missing, _block)
-                if isinstance(value, Struct):
-                    structs.append((key, value))
-                    del self[key]
-                elif isinstance(value, list):
-                    value = _expand_list(value)
-                    if len(value) != len(map):
-                        raise errors.StructError(self, "Invalid @map list: "
-                                "expected length is %s, %s has length of %s" %
-                                (len(map), key, len(value)))
-                    lists.append((key, value))
-                    del self[key]
-                else:
-                    self.set(key, value, self.keep)
+        self._check_frozen()
+        expander = _Expander(defaults, ignore_missing, self, recursive,
+                lazy)
 
-            for key, orig in structs:
-                for i, suffix in enumerate(map):
-                    name = "%s%s" % (key, suffix)
-                    if not self.validate_key(name):
-                        raise errors.StructError(self, "Invalid @map list: "
-                                "key contains invalid characters: %r" % suffix)
-                    new = orig.copy(name=name, container=self)
-                    self[name] = new
-
-                    for item_key, item_values in lists:
-                        new[item_key] = item_values[i]
+        if lazy:
+            if self.container is not None:
+                raise errors.StructError(self,
+                    "Lazy expansion must start at the root Struct")
+            expander.apply_maps(self)
+            self._expander = expander
+        elif paths is None:
+            expander.expand(self)
+
+        if paths is not None:
+            for path in paths:
+                expander.resolve(self, path)
+
+        if stats is not None:
+            stats.update(expander.stats())
+
+    def expandall(self):
+        """Expand everything in this :class:`Struct` that a lazy
+        expansion has not reached yet, raising any errors that
+        :meth:`expand` would have. Handy for validating a file that
+        is normally parsed lazily. Does nothing if the tree is not
+        being expanded lazily.
+        """
 
-                    if recursive:
-                        new.expand(defaults, ignore_missing, True, _block)
+        expander = self.tree_root._expander
+        if expander is None:
+            return
 
-        else:
-            for key in self:
-                value = self.expanditem(key, defaults, ignore_missing, _block)
-                self.set(key, value, self.keep)
-                if recursive and isinstance(value, Struct):
-                    value.expand(defaults, ignore_missing, True, _block)
+        expander.expand(self)
+        if self is self.tree_root:
+            # Nothing is left to expand
+            self._expander = None
 
-    def expanditem(self, path, defaults=(), ignore_missing=(), _block=()):
+    def expanditem(self, path, defaults=(), ignore_missing=()):
         """Fetch and expand an item at the given path. All :class:`Link`
         and sub-string variables will be followed in the process. This
         method is a no-op if value is a :class:`Struct`, use the
@@ -847,33 +1613,11 @@ class Struct(Node, OrderedDict):
         :param path: A key or arbitrary path to get.
         :param defaults: See :meth:`expandvalue`
         :param ignore_missing: See :meth:`expandvalue`
-        :param _block: See :meth:`expandvalue`
         """
 
-        parent, key = self._get_next_parent(path)
-
-        if parent is self:
-            abspath = self.path(key)
-            if abspath in _block:
-                raise errors.StructError(self,
-                        "Circular reference to %s" % abspath)
-
-            _block = list(_block)
-            _block.append(abspath)
-
-            try:
-                value = self[key]
-            except errors.KeyMissingError:
-                if key in defaults:
-                    return defaults[key]
-                else:
-                    raise
-
-            return self.expandvalue(value, defaults, ignore_missing, _block)
-        else:
-            return parent.expanditem(key, defaults, ignore_missing, _block)
+        return _Expander(defaults, ignore_missing).resolve(self, path)
 
-    def expandvalue(self, value, defaults=(), ignore_missing=(), _block=()):
+    def expandvalue(self, value, defaults=(), ignore_missing=()):
         """Use this :class:`Struct` to expand the given value. All
         :class:`Link` and sub-string variables will be followed in
         the process. This method is a no-op if value is a
@@ -890,65 +1634,18 @@ class Struct(Node, OrderedDict):
             then all are ignored. Otherwise raise
             :exc:`~errors.KeyMissingError`.
         :type ignore_missing: *True* or any container
-        :param _block: a set of absolute paths that cannot be expanded.
-            This is only for use internally to avoid circular references.
-        :type block: any container
         """
 
-        def expand_substr(match):
-            subkey = match.group(1)
-            try:
-                subval = self.expanditem(subkey,
-                        defaults, ignore_missing, _block)
-            except errors.KeyMissingError, ex:
-                if ignore_missing is True or ex.key in ignore_missing:
-                    return match.group(0)
-                else:
-                    raise
-
-            return str(subval)
-
-        def expand_link(link):
-            try:
-                subval = self.expanditem(link.path,
-                        defaults, ignore_missing, _block)
-            except errors.KeyMissingError, ex:
-                if ignore_missing is True or ex.key in ignore_missing:
-                    return link
-                else:
-                    raise
-
-            # Structs and lists must be copied
-            if isinstance(subval, Struct):
-                subval = subval.copy()
-            if isinstance(subval, list):
-                subval = List(subval)
-
-            return subval
-
-        def expand_list(list_):
-            for i in xrange(len(list_)):
-                if isinstance(list_[i], basestring):
-                    list_[i] = self.EXPAND.sub(expand_substr, list_[i])
-                elif isinstance(list_[i], list):
-                    expand_list(list_[i])
-
-        # defaults should only contain simple keys, not paths.
-        for key in defaults:
-            assert "." not in key
-
-        # allow ignore_missing=False
-        if ignore_missing is False:
-            ignore_missing = ()
+        expander = _Expander(defaults, ignore_missing)
 
         if isinstance(value, Struct):
             pass
         elif isinstance(value, basestring):
-            value = self.EXPAND.sub(expand_substr, value)
+            value = expander.expand_string(self, value)
         elif isinstance(value, Link):
-            value = expand_link(value)
+            value = expander.expand_link(self, value)
         elif isinstance(value, list):
-            expand_list(value)
+            expander.expand_list(self, value)
 
         return value
 
@@ -996,23 +1693,96 @@ class Struct(Node, OrderedDict):
 
         return unexpanded_list(self.values())
 
-    def dict(self):
-        """Recursively copy this :class:`Struct` into normal *dict* objects"""
+    def dict(self, immutable=False):
+        """Recursively copy this :class:`Struct` into normal *dict* objects
 
-        new = {}
-        for key, value in self.iteritems():
-            if isinstance(value, Node):
-                value = value._pystd()
-            elif isinstance(value, dict):
-                value = value.copy()
-            elif isinstance(value, list):
-                value = _copy_list(value)
-            new[key] = value
+        :param immutable: Copy into read-only dicts and tuples rather
+            than dicts and lists. The result is kept and returned
+            again until this :class:`Struct` or anything below it
+            changes, unchanged children keep theirs as well, so it
+            can be handed to any number of readers without a copy
+            being made for each.
+        :type immutable: *bool*
+        """
 
-        return new
+        if immutable:
+            cached = self._readonly
+            if cached is not None and cached[0] == self._revision:
+                return cached[1]
+            new_dict = _ReadOnlyDict
+        else:
+            new_dict = dict
+        setitem = dict.__setitem__
+
+        # Child Structs are queued along with the dict to fill in
+        # rather than recursed into.
+        root = new_dict()
+        stack = [(self, root)]
+        done = []
+        while stack:
+            struct, new = stack.pop()
+            done.append((struct, new))
+            for key, value in struct.iteritems():
+                if isinstance(value, Struct):
+                    # Unchanged children are shared with earlier results
+                    cached = value._readonly
+                    if (immutable and cached is not None and
+                            cached[0] == value._revision):
+                        value = cached[1]
+                    else:
+                        child = new_dict()
+                        stack.append((value, child))
+                        value = child
+                elif isinstance(value, list):
+                    value = _plain_list(value, immutable)
+                elif isinstance(value, Node):
+                    value = value._pystd()
+                elif isinstance(value, dict):
+                    value = new_dict(value)
+                setitem(new, key, value)
+
+        # Only cache complete results, expanding a value may fail.
+        if immutable:
+            for struct, new in done:
+                struct._readonly = (struct._revision, new)
+
+        return root
 
     _pystd = dict
 
+    def flatten(self, absolute=False):
+        """Generate (path, value) pairs for every value in this
+        :class:`Struct` tree, sub-structs are descended into rather
+        than returned. Paths are relative to this :class:`Struct`
+        unless absolute is True.
+
+        :param absolute: Generate absolute paths starting at @root.
+        :type absolute: *bool*
+        """
+
+        if absolute:
+            prefix = "%s." % self.node_path
+        else:
+            prefix = ""
+
+        # Each sub-struct builds its prefix once and shares it among
+        # all of its keys rather than joining the path for each one.
+        stack = []
+        items = self.iteritems()
+        while True:
+            for key, value in items:
+                if isinstance(value, Struct):
+                    stack.append((items, prefix))
+                    items = value.iteritems()
+                    prefix = "%s%s." % (prefix, key)
+                    break
+                else:
+                    yield prefix + key, value
+            else:
+                if not stack:
+                    return
+                items, prefix = stack.pop()
+
     def path(self, path=None):
         """Get the absolute path of this :class:`Struct` if path is
         *None*, otherwise the relative path from this :class:`Struct`
@@ -1037,43 +1807,237 @@ class Struct(Node, OrderedDict):
         :type prefix: string
         """
 
-        def stritem(item):
-            # FIXME: unicode breaks this, we need to handle encodings
-            # explicitly in Structs rather than just in Parser
-            if isinstance(item, basestring):
-                # Should we use """ for multi-line strings?
-                item = item.replace('\\', '\\\\')
-                item = item.replace('\n', '\\n')
-                item = item.replace('\r', '\\r')
-                item = item.replace('"', '\\"')
-                return '"%s"' % item
-            elif isinstance(item, (list, tuple)):
-                return "[%s]" % " ".join([stritem(x) for x in item])
-            elif (isinstance(item, (int, long, float)) or
-                    item in (True, False, None)):
-                return str(item)
+        return "".join(self.iterstring(strict, prefix))
+
+    def iterstring(self, strict=True, prefix=''):
+        """Generate the coil text format of this :class:`Struct` tree
+        in chunks. Joined together the chunks are the same as the
+        output of :meth:`string`, which is built on this.
+
+        :param strict: If True then fail if the tree contains any
+            values that cannot be represented in the coil text format.
+        :type strict: *bool*
+        :param prefix: Start each line with the given prefix.
+        :type prefix: string
+        """
+
+        # Walk the tree with an explicit stack so the cost of each
+        # chunk does not depend on how deep it is. Lines are joined
+        # by emitting a newline before every item but the first.
+        stack = []
+        node = self
+        items = self.iteritems()
+        first = True
+
+        while True:
+            for key, val in items:
+                # This should never happen, but might as well be safe
+                assert self.KEY.match(key)
+
+                if first:
+                    first = False
+                else:
+                    yield "\n"
+
+                if isinstance(val, Struct):
+                    if val:
+                        yield "%s%s: {\n" % (prefix, key)
+                        stack.append((node, items, prefix))
+                        node = val
+                        items = val.iteritems()
+                        prefix = "%s    " % prefix
+                        first = True
+                        break
+                    else:
+                        yield "%s%s: {}" % (prefix, key)
+                else:
+                    yield "%s%s: %s" % (prefix, key, _stritem(node, val))
             else:
-                raise errors.StructError(self,
-                    "%s cannot be represented in the coil text format" % item)
+                if not stack:
+                    return
+                node, items, prefix = stack.pop()
+                first = False
+                yield "\n%s}" % prefix
+
+    def write(self, fileobj, strict=True):
+        """Write this :class:`Struct` tree to a file in the coil text
+        format. The output is the same as :meth:`string` but is
+        written in batches rather than built up in memory first.
 
-        result = ""
+        :param fileobj: The file, or any object with a write method.
+        :param strict: If True then fail if the tree contains any
+            values that cannot be represented in the coil text format.
+        :type strict: *bool*
+        """
 
-        for key, val in self.iteritems():
-            # This should never happen, but might as well be safe
-            assert self.KEY.match(key)
+        _write_chunks(fileobj, self.iterstring(strict))
 
-            result = "%s%s%s: " % (result, prefix, key)
+    def iterjson(self):
+        """Generate the JSON form of this :class:`Struct` tree in
+        chunks, keeping the order of the keys. Unlike passing the
+        result of :meth:`dict` to :func:`json.dumps` no copy of the
+        tree is made first.
+        """
 
-            if isinstance(val, Struct):
-                child = val.string(strict, "%s    " % prefix)
-                if child:
-                    result = "%s{\n%s\n%s}\n" % (result, child, prefix)
+        from json.encoder import encode_basestring_ascii as encode
+
+        # Each item is one chunk. Strings and ints are by far the
+        # most common values so they are formatted here directly.
+        stack = []
+        node = self
+        keys = iter(self)
+        sep = ""
+        yield "{"
+
+        while True:
+            for key in keys:
+                val = node._get(key)
+                cls = type(val)
+                if cls is str or cls is unicode:
+                    val = encode(val)
+                elif cls is int:
+                    val = str(val)
+                elif isinstance(val, Struct):
+                    yield "%s%s: {" % (sep, encode(key))
+                    stack.append((node, keys))
+                    node = val
+                    keys = iter(val)
+                    sep = ""
+                    break
                 else:
-                    result += "{}\n"
+                    if isinstance(val, Node):
+                        val = node[key]
+                    val = _jsonitem(node, val, encode)
+                yield "%s%s: %s" % (sep, encode(key), val)
+                sep = ", "
             else:
-                result = "%s%s\n" % (result, stritem(val))
+                yield "}"
+                if not stack:
+                    return
+                node, keys = stack.pop()
+                sep = ", "
+
+    def to_json(self, fileobj):
+        """Write this :class:`Struct` tree to a file as JSON.
 
-        return result.rstrip()
+        :param fileobj: The file, or any object with a write method.
+        """
+
+        _write_chunks(fileobj, self.iterjson())
+
+    @classmethod
+    def from_json(cls, source):
+        """Build a new :class:`Struct` tree from JSON. Objects are
+        turned into :class:`Struct` objects as they are decoded and
+        keep the order of their keys.
+
+        :param source: The JSON text or a file to read it from.
+        :return: The root of the new tree.
+        :rtype: :class:`Struct`
+        """
+
+        import json
+
+        if hasattr(source, 'read'):
+            source = source.read()
+
+        match = cls.KEY.match
+        setitem = dict.__setitem__
+        # Objects are decoded before the object containing them so
+        # relative references can only be resolved, by wrapping the
+        # values holding them, once the whole tree is in place.
+        pending = []
+
+        def build(pairs):
+            # The Struct is new so its key order can be built in one go
+            new = cls()
+            keys = []
+            for key, value in pairs:
+                if not match(key):
+                    raise errors.KeyValueError(new, key)
+                key = str(key)
+                if isinstance(value, Struct):
+                    value._set_container(new, key)
+                elif isinstance(value, list) or (
+                        isinstance(value, basestring) and "${" in value):
+                    pending.append((new, key, value))
+                setitem(new, key, value)
+                keys.append(key)
+            if len(keys) != len(new):
+                # Repeated keys keep their first position as set() does
+                seen = set()
+                keys = [k for k in keys if not (k in seen or seen.add(k))]
+            new._order = keys
+            return new
+
+        root = json.loads(source, object_pairs_hook=build)
+        if not isinstance(root, Struct):
+            raise errors.StructError(cls(),
+                    "JSON data must be an object, not %s" %
+                    type(root).__name__)
+        get = dict.get
+        for container, key, value in pending:
+            # Skip values replaced by a repeated key, the last one wins
+            if get(container, key) is value:
+                container._set(key, container._wrap(key, value))
+        return root
+
+    @classmethod
+    def from_mapping(cls, data, trusted=True):
+        """Build a new :class:`Struct` tree from nested mappings such
+        as dicts. The result is the same as ``Struct(data)`` but the
+        tree is built in a single pass without going through
+        :meth:`set` for each item.
+
+        :param data: A *dict*, *Struct*, or a sequence of (key, value)
+            tuples, values may be further mappings or sequences.
+        :param trusted: Assume all keys are valid rather than checking
+            each one and raising :exc:`~errors.KeyValueError`.
+        :type trusted: *bool*
+        :return: The root of the new tree.
+        :rtype: :class:`Struct`
+        """
+
+        root = cls()
+        setitem = dict.__setitem__
+        match = cls.KEY.match
+        # Each child Struct is attached to its container before its own
+        # items are added so values with relative references resolve.
+        stack = [(root, data)]
+        while stack:
+            new, data = stack.pop()
+            if hasattr(data, 'iteritems'):
+                data = data.iteritems()
+            keys = []
+            for key, value in data:
+                if not trusted:
+                    if not isinstance(key, basestring):
+                        raise errors.KeyTypeError(new, key)
+                    elif not match(key):
+                        raise errors.KeyValueError(new, key)
+                if value is None or isinstance(value, _SCALARS):
+                    pass
+                elif isinstance(value, basestring):
+                    if "${" in value:
+                        value = new._wrap(key, value)
+                elif isinstance(value, Struct):
+                    value = cls(value, new, key, value)
+                elif isinstance(value, dict):
+                    child = cls(container=new, name=key)
+                    stack.append((child, value))
+                    value = child
+                elif isinstance(value, Node):
+                    value = value.copy(new, key)
+                else:
+                    value = new._wrap(key, value)
+                setitem(new, key, value)
+                keys.append(key)
+            if len(keys) != len(new):
+                # Repeated keys keep their first position as set() does
+                seen = set()
+                keys = [k for k in keys if not (k in seen or seen.add(k))]
+            new._order = keys
+        return root
 
     def __str__(self):
         return self.string()
@@ -1083,8 +2047,48 @@ class Struct(Node, OrderedDict):
                  for key, val in self.iteritems()]
         return "%s({%s})" % (self.__class__.__name__, ", ".join(attrs))
 
+    def content_hash(self):
+        """Get a hash of the contents of this :class:`Struct` tree
+        such that equal trees have equal hashes. The hash of each
+        :class:`Struct` is cached until it or anything below it is
+        modified, so checking whether a large tree changed is cheap
+        after the first time. Like :func:`hash` the value is only
+        meaningful within one process.
+        """
+
+        if self._hash is not None:
+            return self._hash
+
+        # Child Structs are finished before their container, until
+        # then they stand in for their own hash in its list of items.
+        stack = [(self, self.iteritems(), [])]
+        while stack:
+            struct, items, hashes = stack[-1]
+            for key, value in items:
+                if isinstance(value, Struct):
+                    hashes.append((key, value))
+                    if value._hash is None:
+                        stack.append((value, value.iteritems(), []))
+                        break
+                elif isinstance(value, list):
+                    hashes.append((key, _content_hash(value)))
+                else:
+                    hashes.append((key, hash(value)))
+            else:
+                stack.pop()
+                for i, (key, value) in enumerate(hashes):
+                    if isinstance(value, Struct):
+                        hashes[i] = (key, value.content_hash())
+                struct._hash = hash(tuple(hashes))
+
+        return self._hash
+
     def __eq__(self, other):
         if isinstance(other, Struct):
+            if self is other:
+                return True
+            elif self.content_hash() != other.content_hash():
+                return False
             return self.items() == other.items()
         else:
             return self.dict() == dict(other)
@@ -1092,63 +2096,691 @@ class Struct(Node, OrderedDict):
     def __ne__(self, other):
         return not self == other
 
-    def _get_next_parent(self, path, add_parents=False):
+    def __hash__(self):
+        if not self._frozen:
+            raise TypeError("unhashable type: '%s'" % self.__class__.__name__)
+        return self.content_hash()
+
+    def freeze(self):
+        """Make this :class:`Struct` tree immutable and hashable so it
+        can be shared between threads without locking or copying.
+        Anything left by a lazy :meth:`expand` is expanded first and
+        the :meth:`content_hash` of every :class:`Struct` is computed
+        so that reading the tree never modifies it. Afterwards any
+        attempt to modify a :class:`Struct` or :class:`List` in the
+        tree raises :exc:`~errors.FrozenError`.
+
+        The tree is frozen in place rather than copied, use
+        :meth:`copy` first to keep a mutable version. Copies of a
+        frozen tree are mutable.
+
+        :return: this :class:`Struct`
+        """
+
+        self.expandall()
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._frozen = True
+            if isinstance(node, Struct):
+                items = (node._get(key) for key in node)
+            else:
+                items = list.__iter__(node)
+            for value in items:
+                if isinstance(value, (Struct, List)):
+                    stack.append(value)
+
+        self.content_hash()
+        return self
+
+    def _get_next_parent(self, path, add_parents=False, missing=False):
         """Returns the next Struct in a path and the remaining path.
 
         If the path is a single key just return self and the key.
         If add_parents is true then create parent Structs as needed.
+        If missing is true then return (None, None) rather than raise
+        :exc:`~errors.KeyMissingError` if a parent does not exist.
+        The path may be a string or a compiled :class:`Path`.
         """
 
-        if not isinstance(path, basestring):
+        if isinstance(path, basestring):
+            if "." not in path and not path.startswith("@root"):
+                # Quick exit for the simple case...
+                return self, path
+        elif not isinstance(path, Path):
             raise errors.KeyTypeError(self, path)
 
-        if path.startswith("@root"):
-            if self.container:
-                parent = self.container
-            else:
-                parent = self
-                path = path[5:]
-        elif "." not in path:
-            # Quick exit for the simple case...
-            return self, path
-        elif path.startswith(".."):
-            if self.container:
-                parent = self.container
+        index = self.tree_root._index
+        if index is not None:
+            try:
+                parent_path, dot, key = \
+                        self.absolute_path(path).rpartition('.')
+            except errors.NodeError:
+                pass # Reported below
             else:
-                raise errors.StructError(self, "Reference past root")
-            path = path[1:]
-        elif path.startswith("."):
+                parent = index.get(parent_path)
+                if parent is not None:
+                    return parent, key
+
+        if not isinstance(path, Path):
+            try:
+                path = Path.compile(path)
+            except ValueError:
+                raise errors.KeyValueError(self, path)
+
+        depth = path[0]
+        if depth is None:
+            parent = self.tree_root
+        else:
             parent = self
-            path = path[1:]
+            for i in xrange(depth):
+                parent = parent.container
+                if parent is None:
+                    raise errors.StructError(self, "Reference past root")
+
+        last = len(path) - 1
+        if not last:
+            return parent, ""
+
+        for i in xrange(1, last):
+            key = path[i]
+            node = parent._lookup(key)
+            if node is _missing:
+                if add_parents:
+                    node = parent.__class__(container=parent, name=key)
+                    parent.set(key, node)
+                elif missing:
+                    return None, None
+                else:
+                    raise errors.KeyMissingError(parent, key)
+            elif not isinstance(node, Struct):
+                # Links are followed if the tree is expanded lazily
+                node = parent.get(key)
+                if not isinstance(node, Struct):
+                    raise errors.ValueTypeError(
+                            parent, key, type(node), Struct)
+            parent = node
+
+        if index is not None:
+            index[parent.node_path] = parent
+
+        return parent, path[last]
+
+
+def diff(old, new):
+    """Compare two :class:`Struct` trees. Only sub-structs that are
+    the same object in both trees are skipped without looking at
+    their items, equal :meth:`Struct.content_hash` values do not
+    prove equal contents.
+
+    :param old: The original tree.
+    :type old: :class:`Struct`
+    :param new: The tree to compare against it.
+    :type new: :class:`Struct`
+    :return: Three lists of paths relative to the given Structs:
+        those only found in new, those only found in old, and those
+        with different values. A sub-struct found in only one of the
+        trees is listed rather than each item inside it.
+    :rtype: (added, removed, changed)
+    """
+
+    added = []
+    removed = []
+    changed = []
+
+    if old is new:
+        return added, removed, changed
+
+    stack = [(old, old.iteritems(), new, "")]
+    while stack:
+        old, items, new, prefix = stack[-1]
+        for key, value in items:
+            path = prefix + key
+            other = new.get(key, _missing)
+            if other is _missing:
+                removed.append(path)
+            elif isinstance(value, Struct) and isinstance(other, Struct):
+                if value is not other:
+                    stack.append((value, value.iteritems(), other,
+                                  "%s." % path))
+                    break
+            elif (isinstance(value, Struct) or isinstance(other, Struct)
+                    or value != other):
+                changed.append(path)
         else:
-            # check for mid-path parent references
-            if ".." in path:
-                raise errors.KeyValueError(self, path)
+            stack.pop()
+            for key in new:
+                if key not in old:
+                    added.append(prefix + key)
 
-            split = path.split(".", 1)
-            key = split.pop(0)
-            if split:
-                path = split[0]
-            else:
-                path = ""
+    return added, removed, changed
+
+
+class _MissingItem(object):
+    """Private: an item :class:`_Expander` could not find.
+
+    Missing items are common when expanding with defaults and
+    ignore_missing so the :exc:`~errors.KeyMissingError` is only
+    built if it is actually raised.
+    """
+
+    __slots__ = ('parent', 'key')
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+
+    def error(self):
+        return errors.KeyMissingError(self.parent, self.key)
+
+
+class _Expander(object):
+    """Private: the engine behind :meth:`Node.expand` and friends.
+
+    Links and sub-string variables form a graph between the nodes of
+    a coil tree. The graph is walked depth first, resolving the
+    references of a node before the node itself, so every node is
+    evaluated exactly once and in topological order. The paths of the
+    nodes currently being evaluated are kept in a set which detects a
+    cycle as soon as the walk reaches one of them again.
+
+    The walk follows chains of references of any length without
+    recursing: each step is a generator which yields the generator of
+    a step it depends on and is sent that step's result, :meth:`_run`
+    keeps the generators waiting for a result on a stack. A step gives
+    its own result by yielding anything other than a generator.
+
+    Only nodes inside *scope* are modified in place, anything outside
+    of it is evaluated without changing the tree. If *scope* is None
+    nothing is modified.
+
+    A *lazy* expander is kept by a tree and evaluates its nodes as
+    they are read, possibly by several threads. Each evaluation holds
+    a lock so only one thread walks the graph at a time, and storing
+    the results in the tree is not counted as a change to it since
+    readers see the same values before and after.
+    """
+
+    def __init__(self, defaults=(), ignore_missing=(), scope=None,
+            recursive=True, lazy=False):
+        # Validate and index defaults and ignore_missing once so every
+        # lookup during the expansion is a single hash lookup.
+        self.defaults = dict(defaults)
+        for key in self.defaults:
+            # defaults should only contain simple keys, not paths.
+            assert "." not in key
+
+        # allow ignore_missing=False
+        self.ignore_all = ignore_missing is True
+        if self.ignore_all or not ignore_missing:
+            self.ignore_missing = frozenset()
+        else:
+            self.ignore_missing = frozenset(ignore_missing)
+
+        # The scope is referenced weakly, a lazy expansion keeps the
+        # expander on the root Struct which is usually the scope.
+        if scope is None:
+            self._scope = None
+        else:
+            self._scope = weakref.ref(scope)
+        self.recursive = recursive
+        self.lazy = lazy
+        if lazy:
+            self._lock = threading.RLock()
+        else:
+            self._lock = None
+
+        # Expanded values of Leaf, Link, and List nodes by absolute path
+        self._values = {}
+        # Fully expanded Structs by absolute path
+        self._structs = {}
+        # Absolute paths of the nodes currently being evaluated
+        self._active = set()
+        # Results of lookup() by (reference Struct path, path) so
+        # repeated references cost a single lookup. A missing item is
+        # remembered as a _MissingItem so that ignore_missing is
+        # still applied by each caller.
+        self._resolved = {}
+        #: Number of lookup() calls answered from memory
+        self.hits = 0
+        #: Number of lookup() calls that had to search the tree
+        self.misses = 0
+
+    def _ignored(self, key):
+        return self.ignore_all or key in self.ignore_missing
+
+    @property
+    def scope(self):
+        if self._scope is None:
+            return None
+        else:
+            return self._scope()
+
+    def in_scope(self, node):
+        """Check if node may be modified in place."""
+
+        scope = self.scope
+        if scope is None:
+            return False
+        elif not self.recursive:
+            return node is scope or (node.container is scope
+                    and not isinstance(node, Struct))
 
+        while node is not None:
+            if node is scope:
+                return True
+            node = node.container
+        return False
+
+    @staticmethod
+    def _run(step):
+        """Run a step and everything it depends on, see the class
+        docs, and return its result."""
+
+        stack = [step]
+        push = stack.append
+        pop = stack.pop
+        generator = types.GeneratorType
+        value = error = None
+        while stack:
             try:
-                parent = self.get(key)
-            except errors.KeyMissingError:
-                if add_parents:
-                    parent = self.__class__(container=self, name=key)
-                    self.set(key, parent)
+                if error is None:
+                    value = stack[-1].send(value)
                 else:
+                    thrown, error = error, None
+                    value = stack[-1].throw(*thrown)
+            except StopIteration:
+                pop()
+                value = None
+            except Exception:
+                # Pass the error on to the step waiting for this one
+                pop()
+                if not stack:
                     raise
+                error = sys.exc_info()
+            else:
+                if type(value) is generator:
+                    push(value)
+                    value = None
+                else:
+                    # Steps never give a result inside a try block so
+                    # there is nothing left for close() to clean up.
+                    pop()
+        return value
+
+    def expand(self, node):
+        """Expand the given node in place."""
+
+        if self._lock is not None:
+            self._lock.acquire()
+        try:
+            if isinstance(node, Struct):
+                self.expand_struct(node)
+            elif isinstance(node, Leaf) and node._template is not None:
+                node._update(self.evaluate(node), not self.lazy)
+            elif isinstance(node, List):
+                self.expand_list(node.container, node)
+        finally:
+            if self._lock is not None:
+                self._lock.release()
+
+    def expand_struct(self, struct):
+        """Expand all items in struct and, if recursive, all children."""
+
+        self._run(self._expand_struct(struct))
+
+    def _expand_struct(self, struct):
+        path = struct.node_path
+        if self._structs.get(path) is struct:
+            return
+        elif path in self._active:
+            raise errors.CircularReference(struct, path)
+
+        self._active.add(path)
+        try:
+            self._apply_map(struct)
+            for key in struct.keys():
+                node = struct._get(key)
+                if isinstance(node, Node) and not isinstance(node, Struct):
+                    value = self._known(node)
+                    if value is _missing:
+                        value = yield self._evaluate(node)
+                    node = value
+                if self.recursive and isinstance(node, Struct):
+                    yield self._expand_struct(node)
+        finally:
+            self._active.discard(path)
+
+        self._structs[path] = struct
+
+    def _known(self, node):
+        """Get the value of node if it needs no evaluation or was
+        evaluated already, otherwise :data:`_missing`."""
+
+        if not isinstance(node, Node):
+            return node
+        elif isinstance(node, Leaf) and node._template is None:
+            return node.leaf_value
+        else:
+            return self._values.get(node.node_path, _missing)
+
+    def evaluate(self, node):
+        """Get the expanded value of a :class:`Leaf`, :class:`Link`, or
+        :class:`List`. If the node is in scope the tree is updated.
+        A :class:`Link` is returned if it could not be expanded.
+        """
+
+        value = self._known(node)
+        if value is _missing and self._lock is None:
+            value = self._run(self._evaluate(node))
+        elif value is _missing:
+            self._lock.acquire()
+            try:
+                # Another thread may have evaluated it in the meantime
+                value = self._known(node)
+                if value is _missing:
+                    value = self._run(self._evaluate(node))
+            finally:
+                self._lock.release()
+        return value
+
+    def _evaluate(self, node):
+        path = node.node_path
+        if path in self._active:
+            raise errors.CircularReference(node.container, path)
+
+        in_scope = self.in_scope(node)
+        self._active.add(path)
+        try:
+            if isinstance(node, Leaf):
+                value = yield self._expand_template(
+                        node.container, node._template)
+            elif isinstance(node, Link):
+                value = self._remembered(node.container, node.link_path)
+                if value is _missing:
+                    value = yield self._lookup(node.container, node.link_path)
+                value = self._follow(node, value)
+            elif isinstance(node, List):
+                if in_scope:
+                    value = node
+                else:
+                    value = node.copy(node.container, node.node_name)
+                yield self._expand_list(node.container, value)
+            else:
+                value = node
+        finally:
+            self._active.discard(path)
+
+        self._values[path] = value
+        if in_scope and value is not node:
+            # Update the tree in place rather than going through set()
+            # which would re-validate the key and drop the location.
+            container = node.container
+            wrapped = container._wrap(node.node_name, value)
+            if self.lazy:
+                _OrderedMapping.__setitem__(container, node.node_name,
+                        wrapped)
+            else:
+                container._set(node.node_name, wrapped)
+
+        yield value
+
+    def forget(self):
+        """Drop all remembered results, the tree has been modified."""
+
+        self._values.clear()
+        self._structs.clear()
+        self._resolved.clear()
+
+    def apply_maps(self, struct):
+        """Apply every @map in struct and all of its children."""
 
-            if not isinstance(parent, Struct):
-                raise errors.ValueTypeError(self, key, type(parent), Struct)
+        stack = [struct]
+        while stack:
+            struct = stack.pop()
+            self._apply_map(struct)
+            for key in struct:
+                node = struct._get(key)
+                if isinstance(node, Struct):
+                    stack.append(node)
 
-        if parent is self and "." in path:
-            # Great, we went nowhere but there is still somewhere to go
-            parent, path = self._get_next_parent(path, add_parents)
+    def stats(self):
+        """Report how effective the lookup() memo table was."""
 
-        return parent, path
+        total = self.hits + self.misses
+        if total:
+            rate = float(self.hits) / total
+        else:
+            rate = 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': rate}
+
+    def resolve(self, ref, path):
+        """Find and evaluate the item at path relative to the
+        :class:`Struct` ref. Links found along the way are followed.
+        A :class:`Link` is returned if the path could not be expanded
+        due to ignore_missing.
+        """
+
+        value = self.lookup(ref, path)
+        if isinstance(value, _MissingItem):
+            raise value.error()
+        return value
+
+    def lookup(self, ref, path):
+        """Same as :meth:`resolve` but a missing item is returned as
+        a :class:`_MissingItem` rather than raised.
+        """
+
+        value = self._remembered(ref, path)
+        if value is _missing:
+            value = self._run(self._lookup(ref, path))
+        return value
+
+    def _remembered(self, ref, path):
+        """Get the result of an earlier lookup() of path relative to
+        ref, :data:`_missing` if there was none."""
+
+        value = self._resolved.get((ref.node_path, path), _missing)
+        if value is not _missing:
+            self.hits += 1
+        return value
+
+    def _lookup(self, ref, path):
+        self.misses += 1
+        try:
+            compiled = Path.compile(path)
+        except ValueError:
+            raise errors.KeyValueError(ref, path)
+
+        depth = compiled[0]
+        if depth is None:
+            parent = ref.tree_root
+        else:
+            parent = ref
+            for i in xrange(depth):
+                parent = parent.container
+                if parent is None:
+                    raise errors.NodeError(ref,
+                            "Reference past root node in %r" % str(path))
+        self._apply_map(parent)
+
+        value = _missing
+        for key in compiled[1:-1]:
+            node = parent._lookup(key)
+            if node is _missing:
+                value = _MissingItem(parent, key)
+                break
+            elif isinstance(node, Link):
+                link = node
+                node = self._known(link)
+                if node is _missing:
+                    node = yield self._evaluate(link)
+                if isinstance(node, Link):
+                    value = node
+                    break
+            if not isinstance(node, Struct):
+                if isinstance(node, Leaf):
+                    node = node.leaf_value
+                raise errors.ValueTypeError(parent, key, type(node), Struct)
+            self._apply_map(node)
+            parent = node
+
+        if value is not _missing:
+            pass
+        elif len(compiled) == 1:
+            value = parent
+        else:
+            key = compiled[-1]
+            node = parent._lookup(key)
+            if node is _missing:
+                if key in self.defaults:
+                    value = self.defaults[key]
+                else:
+                    value = _MissingItem(parent, key)
+            elif isinstance(node, Struct):
+                value = node
+            else:
+                value = self._known(node)
+                if value is _missing:
+                    value = yield self._evaluate(node)
+
+        # Anything referring to a Struct in scope expects the result
+        # of expanding it, not whatever state it happens to be in.
+        if isinstance(value, Struct) and self.in_scope(value):
+            yield self._expand_struct(value)
+
+        self._resolved[ref.node_path, path] = value
+        yield value
+
+    def expand_string(self, ref, value):
+        """Expand all sub-string variables in value."""
+
+        return self._run(self._expand_string(ref, value))
+
+    def _expand_string(self, ref, value):
+        template = ref._cls_leaf._compile(value)
+        if template is not None:
+            value = yield self._expand_template(ref, template)
+        yield value
+
+    def expand_template(self, ref, template):
+        """Expand a string template as compiled by :meth:`Leaf._compile`"""
+
+        return self._run(self._expand_template(ref, template))
+
+    def _expand_template(self, ref, template):
+        parts = list(template)
+        for i in xrange(1, len(parts), 2):
+            subval = self._remembered(ref, parts[i])
+            if subval is _missing:
+                subval = yield self._lookup(ref, parts[i])
+            parts[i] = self._substitute(parts[i], subval)
+
+        yield "".join(parts)
+
+    def _substitute(self, path, value):
+        """Format the value of a sub-string variable"""
+
+        if isinstance(value, _MissingItem):
+            if not self._ignored(value.key):
+                raise value.error()
+            return "${%s}" % path
+        elif isinstance(value, Link):
+            return "${%s}" % path
+        else:
+            return str(value)
+
+    def expand_link(self, ref, link):
+        """Follow link, returning link itself if it cannot be expanded."""
+
+        return self._run(self._expand_link(ref, link))
+
+    def _expand_link(self, ref, link):
+        value = self._remembered(ref, link.link_path)
+        if value is _missing:
+            value = yield self._lookup(ref, link.link_path)
+        yield self._follow(link, value)
+
+    def _follow(self, link, value):
+        """Get the value of link given the value it refers to"""
+
+        if isinstance(value, _MissingItem):
+            if self._ignored(value.key):
+                value = link
+            else:
+                raise value.error()
+        elif isinstance(value, (Struct, List)):
+            # Structs and lists must be copied
+            value = value.copy(link.container, link.node_name)
+
+        return value
+
+    def expand_list(self, ref, list_):
+        """Expand all sub-string variables in list_ in place."""
+
+        self._run(self._expand_list(ref, list_))
+
+    def _expand_list(self, ref, list_):
+        if isinstance(list_, List):
+            for i in xrange(len(list_)):
+                item = list_._get(i)
+                if isinstance(item, List):
+                    yield self._expand_list(ref, item)
+                elif isinstance(item, Leaf) and item._template is not None:
+                    value = yield self._expand_template(ref, item._template)
+                    item._update(value, not self.lazy)
+        else:
+            for i in xrange(len(list_)):
+                if isinstance(list_[i], basestring):
+                    list_[i] = yield self._expand_string(ref, list_[i])
+                elif isinstance(list_[i], list):
+                    yield self._expand_list(ref, list_[i])
+
+    def _apply_map(self, struct):
+        """Replace the @map template structs with their instances."""
+
+        if struct._map is None or not self.in_scope(struct):
+            return
+
+        map = _expand_list(struct._map)
+        struct._map = None
+        structs = []
+        lists = []
+
+        # We don't use iter because this loop deletes stuff
+        for key in struct.keys():
+            value = struct._get(key)
+            if not isinstance(value, Struct):
+                value = self.evaluate(value)
+
+            if isinstance(value, Struct):
+                structs.append((key, value))
+            elif isinstance(value, list):
+                value = _expand_list(value)
+                if len(value) != len(map):
+                    raise errors.StructError(struct, "Invalid @map list: "
+                            "expected length is %s, %s has length of %s" %
+                            (len(map), key, len(value)))
+                lists.append((key, value))
+            else:
+                continue
+
+            del struct[key]
+            self._values.pop(struct.path(key), None)
+            self._resolved.clear()
+
+        for key, orig in structs:
+            for i, suffix in enumerate(map):
+                name = "%s%s" % (key, suffix)
+                if not struct.validate_key(name):
+                    raise errors.StructError(struct, "Invalid @map list: "
+                            "key contains invalid characters: %r" % suffix)
+                new = orig.copy(name=name, container=struct)
+                struct[name] = new
+
+                for item_key, item_values in lists:
+                    new[item_key] = item_values[i]
 
 
 # Set the default Node class types
@@ -0,0 +1,57 @@
+"""Tests for coil.handle."""
+
+import os
+import threading
+import unittest
+from coil import handle, struct, errors
+
+class HandleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.handle = handle.ConfigHandle(struct.Struct({'a': 1}))
+
+    def testSnapshot(self):
+        generation, root = self.handle.snapshot()
+        self.assertEquals(generation, 0)
+        self.assert_(root is self.handle.root)
+        self.assert_(root.frozen)
+        self.assertFalse(self.handle.stale(generation))
+        self.assertEquals(handle.ConfigHandle().root, struct.Struct())
+
+    def testPublish(self):
+        old = self.handle.root
+        new = struct.Struct({'a': 2})
+        self.assertEquals(self.handle.publish(new), 1)
+        self.assertEquals(self.handle.snapshot(), (1, new))
+        self.assert_(new.frozen)
+        self.assert_(self.handle.stale(0))
+        self.assertEquals(old['a'], 1)
+
+    def testLoad(self):
+        path = os.path.join(os.path.dirname(__file__), "simple.coil")
+        self.assertEquals(self.handle.load(path), 1)
+        self.assertEquals(self.handle.root['y.z'], "z value")
+        self.assertRaises(IOError, self.handle.load, path + ".missing")
+        self.assertEquals(self.handle.generation, 1)
+
+    def testMerge(self):
+        old = self.handle.root
+        self.assertEquals(self.handle.merge({'b': {'c': 2}}), 1)
+        self.assertEquals(self.handle.root.dict(), {'a': 1, 'b': {'c': 2}})
+        self.assert_(self.handle.root['b'].frozen)
+        self.assertEquals(old.keys(), ['a'])
+        self.assertRaises(errors.FrozenError, old.set, 'b', 1)
+
+    def testConcurrentMerge(self):
+        def merge(i):
+            for j in xrange(20):
+                self.handle.merge({'t%d' % i: j})
+        threads = [threading.Thread(target=merge, args=(i,))
+                   for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(self.handle.generation, 80)
+        for i in xrange(4):
+            self.assertEquals(self.handle.root['t%d' % i], 19)
@@ -14,6 +14,18 @@ class BasicTestCase(unittest.TestCase):
         self.assertEquals(x, "string")
         self.assertEquals(x.node_path, "@root.x")
 
+    def testTemplate(self):
+        x = Leaf("a${b}c${@root.d}", self.r, "x")
+        self.assertEquals(x._template, ("a", "b", "c", "@root.d", ""))
+        y = Leaf("plain $ {} string", self.r, "y")
+        self.assertEquals(y._template, None)
+
+    def testCopyTemplate(self):
+        x = Leaf("${@root.a.b}", self.r['a'], "x")
+        y = x.copy(Struct(), "y")
+        self.assertEquals(y, "${@root.b}")
+        self.assertEquals(y._template, ("", "@root.b", ""))
+
 class ExpansionTestCase(unittest.TestCase):
 
     config = {
@@ -23,6 +35,7 @@ class ExpansionTestCase(unittest.TestCase):
                     'j': "j",
                 },
                 'k': 3,
+                'n': None,
             },
         }
 
@@ -58,6 +71,11 @@ class ExpansionTestCase(unittest.TestCase):
         x.expand()
         self.assertEquals(x, "string3")
 
+    def testNone(self):
+        x = Leaf("string${n}", self.r['a'], "x")
+        x.expand()
+        self.assertEquals(x, "stringNone")
+
     def testAbsolute(self):
         x = Leaf("string${@root.a.k}", self.r['a.b'], "x")
         self.assertEquals(x, "string${@root.a.k}")
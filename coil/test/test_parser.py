@@ -1,7 +1,10 @@
 """Tests for coil.parser."""
 
+import gc
 import os
+import threading
 import unittest
+import weakref
 from coil import parser, struct, parse_file, errors
 
 class BasicTestCase(unittest.TestCase):
@@ -16,6 +19,32 @@ class BasicTestCase(unittest.TestCase):
         self.assertEquals(len(root), 1)
         self.assertEquals(root['this'], "that")
 
+    def testLocations(self):
+        text = ["a: { x: 1 }", "b: { @extends: ..a", "  y: =x }"]
+        root = parser.Parser(text).root()
+        self.assertEquals(root['a'].location('x'), None)
+        root = parser.Parser(text, locations=True).root()
+        self.assertEquals(root['a'].location('x').line, 1)
+        self.assertEquals(root['b'].location('x').line, 1)
+        self.assertEquals(root['b'].location('y').line, 3)
+
+    def testWeakLinks(self):
+        text = ["a: { x: 1 y: =x z: '${x}' }", "b: { @extends: ..a }"]
+        gc.disable()
+        try:
+            p = parser.Parser(text, weak_links=True)
+            prototype = weakref.ref(p._prototype)
+            root = p.root()
+            del p
+            self.assertEquals(prototype(), None)
+            self.assertEquals(root.get('b.y'), 1)
+            self.assertEquals(root.get('b.z'), "1")
+            tree = weakref.ref(root)
+            del root
+            self.assertEquals(tree(), None)
+        finally:
+            gc.enable()
+
     def testMany(self):
         root = parser.Parser(["this: 'that' int: 1 float: 2.0"]).root()
         self.assertEquals(len(root), 3)
@@ -125,6 +154,26 @@ class BasicTestCase(unittest.TestCase):
         self.assertEqual(parser.Parser(["x: =y y: 'foo'"]).root()['x'], "foo")
         self.assertEqual(parser.Parser(["y: 'foo' x: =y"]).root()['x'], "foo")
 
+    def testCircular(self):
+        for coil in (
+            "a: =b b: =a",
+            "a: '${a}'",
+            "a: '${b}' b: '${a}'",
+            "x: { y: =..z } z: =x", # link to a parent
+            ):
+            self.assertRaises(errors.CircularReference, parser.Parser, [coil])
+
+    def testLinkChain(self):
+        root = parser.Parser(["c: =b.x b: =a a: {x: '${..y}'} y: 1"]).root()
+        self.assertEquals(root['c'], "1")
+        self.assertEquals(root['b'], root['a'])
+
+    def testLinkList(self):
+        root = parser.Parser(["a: [1 '${b}'] b: 'x' c: =a"]).root()
+        self.assertEquals(root['c'], [1, 'x'])
+        root['c'].append(2)
+        self.assertEquals(root['a'], [1, 'x'])
+
     def testList(self):
         root = parser.Parser(["x: ['a' 1 2.0 True False None]"]).root()
         self.assertEqual(root['x'], ['a', 1, 2.0, True, False, None])
@@ -203,6 +252,18 @@ class ExtendsTestCase(unittest.TestCase):
         self.assertEquals(self.tree['E']['F']['G']['I']['a'], 1)
         self.assertEquals(self.tree['E']['F']['G']['H'], self.tree['E']['F']['G']['I'])
 
+    def testOrder(self):
+        root = parser.Parser(["a: {x: 1 y: 2 z: 3}"
+                              "b: {@extends: ..a w: 0 y: 4 ~x}"]).root()
+        self.assertEquals(root['b'].keys(), ['y', 'z', 'w'])
+        self.assertEquals(root['b']['y'], 4)
+
+    def testEmpty(self):
+        root = parser.Parser(["a: {} b: { @extends: ..a }"]).root()
+        self.assertEquals(len(root['b']), 0)
+        self.assertRaises(errors.StructError, parser.Parser,
+                          ["a: { b: { @extends: ..a } }"])
+
 class ParseFileTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -310,6 +371,88 @@ class MapTestCase(unittest.TestCase):
         self.assertEquals(self.tree['map2.a3.z'], 3)
         self.assertEquals(self.tree['map2.a3.j'], 9)
 
+class LazyTestCase(unittest.TestCase):
+
+    def testLazy(self):
+        root = parser.Parser(["a: 'x' b: =a c: '${b}y' d: { e: =..c }"],
+                expand='lazy').root()
+        self.assert_(isinstance(root._get('b'), struct.Link))
+        self.assertEquals(root.get('d.e'), "xy")
+        self.assertEquals(root['b'], "x")
+        self.assertEquals(root._get('b'), "x")
+        root.expandall()
+        self.assertEquals(root, parser.Parser(
+            ["a: 'x' b: 'x' c: 'xy' d: { e: 'xy' }"]).root())
+
+    def testErrors(self):
+        root = parser.Parser(["a: =missing b: 1 c: =c"],
+                expand='lazy').root()
+        self.assertEquals(root['b'], 1)
+        self.assertRaises(errors.KeyMissingError, root.get, 'a')
+        self.assertRaises(errors.KeyMissingError, root.get, 'a', None)
+        self.assertRaises(errors.CircularReference, root.get, 'c')
+        self.assertRaises(errors.KeyMissingError, root.expandall)
+
+    def testSet(self):
+        root = parser.Parser(["a: 'x' b: '${a}'"], expand='lazy').root()
+        self.assertEquals(root['b'], "x")
+        root['a'] = "y"
+        root['c'] = "${a}"
+        self.assertEquals(root['b'], "x")
+        self.assertEquals(root['c'], "y")
+
+    def testMap(self):
+        root = parser.Parser(["m: { @map: [1 2] x: [1 2] a: { y: =x } }"],
+                expand='lazy').root()
+        self.assertEquals(root['m'].keys(), ['a1', 'a2'])
+        self.assertEquals(root['m.a2.y'], 2)
+
+    def testRevision(self):
+        root = parser.Parser(["a: 'x' b: =a c: '${b}y' d: { e: =..c }"],
+                expand='lazy').root()
+        revision, hash = root.revision, root.content_hash()
+        self.assertEquals(root.get('d.e'), "xy")
+        self.assertEquals(root.revision, revision)
+        self.assertEquals(root.content_hash(), hash)
+        root.expandall()
+        self.assertEquals(root.revision, revision)
+
+    def testThreads(self):
+        text = "a0: 'x' %s" % " ".join(
+                ["a%d: '${a%d}'" % (i, i - 1) for i in xrange(1, 200)])
+        root = parser.Parser([text], expand='lazy').root()
+        failures = []
+        def read():
+            try:
+                for i in xrange(199, 0, -1):
+                    self.assertEquals(root['a%d' % i], "x")
+            except Exception, ex:
+                failures.append(ex)
+        threads = [threading.Thread(target=read) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(failures, [])
+
+    def testCopy(self):
+        text = ["a: 'x' b: =a c: '${a}y' d: { e: =..a f: ['${..a}'] }"]
+        for method in ('copy', 'struct', 'merge', 'update'):
+            root = parser.Parser(text, expand='lazy').root()
+            if method == 'copy':
+                new = root.copy()
+            elif method == 'struct':
+                new = struct.Struct(root)
+            else:
+                new = struct.Struct()
+                getattr(new, method)(root)
+            self.assertEquals(new._get('b'), "x")
+            self.assertEquals(new._get('c'), "xy")
+        root = parser.Parser(text, expand='lazy').root()
+        self.assertEquals(struct.Struct(root).dict(),
+                {'a': 'x', 'b': 'x', 'c': 'xy', 'd': {'e': 'x', 'f': ['x']}})
+        self.assertEquals(root['d'].copy().dict(), {'e': 'x', 'f': ['x']})
+
 class ReparseTestCase(unittest.TestCase):
 
     def testStringWhitespace(self):
@@ -1,7 +1,13 @@
 """Tests for coil.struct."""
 
+import collections
+import gc
+import pickle
+import StringIO
+import sys
 import unittest
-from coil import struct, errors
+import weakref
+from coil import struct, errors, tokenizer
 
 class BasicTestCase(unittest.TestCase):
 
@@ -31,6 +37,39 @@ class BasicTestCase(unittest.TestCase):
     def testKeyOrder(self):
         self.assertEquals(self.struct.keys(), ['first', 'second', 'last'])
 
+    def testOrder(self):
+        s = struct.Struct([("k%d" % i, i) for i in xrange(10)])
+        s['k3'] = "three"
+        del s['k5']
+        for i in xrange(5):
+            del s["k%d" % (i * 2)]
+        s['k0'] = 0
+        self.assertEquals(s.keys(), ['k1', 'k3', 'k7', 'k9', 'k0'])
+        self.assertEquals(s.values(), [1, "three", 7, 9, 0])
+        self.assertEquals(list(reversed(s)), ['k0', 'k9', 'k7', 'k3', 'k1'])
+        self.assertEquals(s.pop('k7'), 7)
+        self.assertEquals(s.popitem(), ('k0', 0))
+        self.assertEquals(s.popitem(last=False), ('k1', 1))
+        self.assertEquals(s.setdefault('a', 2), 2)
+        self.assertEquals(s.items(), [('k3', "three"), ('k9', 9), ('a', 2)])
+        s.clear()
+        self.assertEquals(s.keys(), [])
+
+    def testOrderReset(self):
+        s = struct.Struct([("k%d" % i, i) for i in xrange(10)])
+        expect = collections.OrderedDict(s.items())
+        for i in [3, 9, 8, 3, 0, 5, 9, 1, 7, 7, 2, 6, 4, 0]:
+            key = "k%d" % i
+            del s[key]
+            del expect[key]
+            self.assertEquals(s.keys(), expect.keys())
+            s[key] = i
+            expect[key] = i
+            self.assertEquals(s.keys(), expect.keys())
+            self.assertEquals(list(reversed(s)), list(reversed(expect)))
+        while s:
+            self.assertEquals(s.popitem(), expect.popitem())
+
     def testGetItem(self):
         self.assertEquals(self.struct['second'], "something else")
 
@@ -61,10 +100,209 @@ class BasicTestCase(unittest.TestCase):
         child = self.struct['first']
         self.assertEquals(child.get('@root.second'), "something else")
 
+    def testCompiledPath(self):
+        for path in ("first.dict.x", "..first.int", "...int",
+                "@root", "@root.first.int"):
+            compiled = struct.Path.compile(path)
+            self.assertEquals(str(compiled), path)
+            self.assert_(struct.Path.compile(path) is compiled)
+        self.assertEquals(struct.Path.compile("first.dict"),
+                struct.Path(0, ["first", "dict"]))
+        self.assertEquals(struct.Path.compile(".first").keys, ("first",))
+        self.assertEquals(struct.Path.compile("..first").depth, 1)
+        self.assertEquals(struct.Path.compile("@root.first").depth, None)
+        self.assertRaises(ValueError, struct.Path.compile, "first..int")
+
+    def testGetCompiledPath(self):
+        child = self.struct['first.dict']
+        self.assertEquals(self.struct.get(struct.Path(0, ["first", "int"])), 1)
+        self.assertEquals(child.get(struct.Path.compile("..int")), 1)
+        self.assertEquals(child.get(struct.Path.compile("@root.second")),
+                "something else")
+        self.assert_(child.get(struct.Path(1)) is self.struct['first'])
+        self.assertEquals(child.get(struct.Path(0, ["bogus", "x"]), 2), 2)
+        self.assertRaises(errors.StructError,
+                child.get, struct.Path(3, ["x"]))
+
+    def testSetCompiledPath(self):
+        s = struct.Struct()
+        s[struct.Path(0, ["new", "sub"])] = True
+        self.assertEquals(s['new.sub'], True)
+        del s[struct.Path(None, ["new", "sub"])]
+        self.assertEquals(s['new'].keys(), [])
+
+    def testIndex(self):
+        s = self.struct.copy()
+        s.use_index()
+        child = s['first.dict']
+        self.assertEquals(s['first.dict.x'], 1)
+        self.assertEquals(child['@root.first.dict.y'], 2)
+        self.assertEquals(child['..int'], 1)
+        self.assert_(s._index['@root.first.dict'] is child)
+        s['first'] = {'dict': {'x': "new"}}
+        self.assertEquals(s['first.dict.x'], "new")
+        self.assertEquals(s.get('first.dict.y', None), None)
+        s.merge(struct.Struct({'first': {'dict': {'y': "merged"}}}))
+        self.assertEquals(s['first.dict.y'], "merged")
+        s.update({'first': {'other': 1}})
+        self.assertEquals(s.get('first.dict.x', None), None)
+        del s['first']
+        self.assertEquals(s.get('first.other', None), None)
+        self.assertRaises(errors.StructError, child.use_index)
+        s.use_index(False)
+        self.assertEquals(s._index, None)
+
+    def testIndexClear(self):
+        s = struct.Struct({'a': {'b': {'c': 1}}, 'd': 2})
+        s.use_index()
+        self.assertEquals(s['a.b.c'], 1)
+        s['a'].clear()
+        self.assertEquals(s.get('a.b.c', "missing"), "missing")
+        s.clear()
+        self.assertEquals(s.get('a.b', "missing"), "missing")
+
+    def testGetMany(self):
+        self.struct.use_index()
+        self.assertEquals(self.struct.get_many(
+                ['first.int', 'second', '@root.first.dict.x']),
+                [1, "something else", 1])
+        self.assertEquals(self.struct.get_many(['bogus.x', 'first'], 0),
+                [0, self.struct['first']])
+        self.assertRaises(errors.KeyMissingError,
+                self.struct.get_many, ['first.bogus'])
+
+    def testMove(self):
+        s = struct.Struct()
+        self.struct['first.link'] = struct.Link("int", self.struct['first'],
+                "link")
+        s['a'] = self.struct['first']
+        self.assertEquals(s['a.dict'].node_path, "@root.a.dict")
+        self.assert_(s['a.dict'].tree_root is s)
+        self.assertEquals(s['a']._get('link').node_path, "@root.a.link")
+
+    def testCompact(self):
+        s = struct.Struct({'a': 1, 'b': "x", 'c': "${a}", 'd': None})
+        self.assertEquals(s._get('a'), 1)
+        self.assertEquals(s._get('b'), "x")
+        self.assert_(isinstance(s._get('c'), struct.Leaf))
+        self.assertEquals(s._get('d'), None)
+        s['e'] = struct.Leaf(2.5, s, 'e')
+        self.assertEquals(s._get('e'), 2.5)
+        s.expand()
+        self.assertEquals(s._get('c'), "1")
+        self.assertRaises(TypeError, s.set, 'f', object())
+
+    def testLocation(self):
+        s = struct.Struct()
+        self.assertEquals(s.location('a'), None)
+        where = tokenizer.Location()
+        where.filePath, where.line, where.column = "x.coil", 3, 1
+        s.set('a', 1, location=where)
+        self.assertEquals(s.location('a').line, 3)
+        s.set('a', 2, location=struct.Struct.keep)
+        self.assertEquals(s.location('a').line, 3)
+        self.assertEquals(s.copy().location('a').filePath, "x.coil")
+        del s['a']
+        self.assertEquals(s.location('a'), None)
+
+    def testWeakLinks(self):
+        s = struct.Struct(self.data, weak_links=True)
+        child = s['first.dict']
+        self.assertEquals(child['..int'], 1)
+        self.assert_(child.tree_root is s)
+        self.assert_(s.copy()['first.dict']._weak_links)
+        ref = weakref.ref(s)
+        gc.disable()
+        try:
+            del s
+            self.assertEquals(ref(), None)
+        finally:
+            gc.enable()
+        self.assertEquals(child.node_path, "@root")
+        self.assert_(child.tree_root is child)
+
+    def testCopyOriginCollected(self):
+        root = struct.Struct({'x': 1, 'a': {}})
+        root['a.l'] = struct.Link('@root.x', root['a'], 'l')
+        root['b'] = root['a'].copy(root, 'b')
+        del root['a']
+        gc.collect()
+        root['q'] = {}
+        root['q'].update({'c': root['b']})
+        self.assertEquals(root['q.c']._get('l').path, "@root.x")
+
     def testIterItems(self):
         itemlist = [("one", 1), ("two", 2), ("three", 3)]
         self.assertEquals(list(struct.Struct(itemlist).iteritems()), itemlist)
 
+    def testFlatten(self):
+        flat = dict(self.struct.flatten())
+        self.assertEquals(len(flat), 8)
+        self.assertEquals(flat['first.dict.z'], "another thing")
+        self.assertEquals(flat['last'], ["list", "of", "strings"])
+        self.assertEquals([path for path, value in self.struct.flatten()][-2:],
+                          ['second', 'last'])
+        sub = self.struct['first.dict']
+        self.assertEquals(dict(sub.flatten(absolute=True))['@root.first.dict.x'],
+                          1)
+        self.assertEquals(list(struct.Struct({'a': {}}).flatten()), [])
+
+    def testFromMapping(self):
+        new = struct.Struct.from_mapping(self.data)
+        self.assertEquals(new, self.struct)
+        self.assertEquals(new.keys(), ['first', 'second', 'last'])
+        self.assert_(new['first.dict'].container is new['first'])
+        self.assertEquals(new['first.dict'].node_path, "@root.first.dict")
+        self.assert_(gc.isenabled())
+        self.assertRaises(errors.KeyValueError,
+                struct.Struct.from_mapping, {'a b': 1}, trusted=False)
+
+    def testFromMappingReferences(self):
+        new = struct.Struct.from_mapping(
+                {'a': 1, 'b': {'c': "${..a}", 'd': ["${@root.a}"]}})
+        new.expand()
+        self.assertEquals(new['b.c'], "1")
+        self.assertEquals(new['b.d'], ["1"])
+
+    def testFromMappingStruct(self):
+        src = struct.Struct({'l': [1, [2]], 's': {'m': [3]}})
+        src['k'] = struct.Link('s', src, 'k')
+        new = struct.Struct.from_mapping(src)
+        self.assertEquals(new['l'], [1, [2]])
+        self.assertEquals(new['k'].path, src['k'].path)
+        self.assert_(new['l'] is not src['l'])
+        self.assert_(src['l'].container is src)
+        self.assert_(src['k'].container is src)
+        self.assert_(new['l'].container is new)
+        new['l'].append(3)
+        new['s.m'].append(4)
+        self.assertEquals(src['l'], [1, [2]])
+        self.assertEquals(src['s.m'], [3])
+
+    def testContentHash(self):
+        other = struct.Struct(self.data)
+        self.assertEquals(self.struct.content_hash(), other.content_hash())
+        self.assertEquals(self.struct['first'].content_hash(),
+                          other['first'].content_hash())
+        other['first.dict.x'] = 2
+        self.assertNotEquals(self.struct.content_hash(), other.content_hash())
+        self.assertNotEquals(self.struct, other)
+        other['first.dict.x'] = 1
+        self.assertEquals(self.struct.content_hash(), other.content_hash())
+        self.assertEquals(self.struct, other)
+        other['last'].append("more")
+        self.assertNotEquals(self.struct.content_hash(), other.content_hash())
+        del other['last']
+        self.assertNotEquals(self.struct.content_hash(), other.content_hash())
+
+    def testContentHashExpand(self):
+        root = struct.Struct({'a': {'x': 1, 'y': "${x}"}, 'b': [ "${a.x}" ]})
+        before = root.content_hash()
+        root.expand()
+        self.assertNotEquals(root.content_hash(), before)
+        self.assertEquals(root.content_hash(),
+            struct.Struct({'a': {'x': 1, 'y': "1"}, 'b': ["1"]}).content_hash())
+
     def testKeyMissing(self):
         self.assertRaises(errors.KeyMissingError, lambda: self.struct['bogus'])
         self.assertRaises(errors.KeyMissingError, self.struct.get, 'bad')
@@ -82,6 +320,33 @@ class BasicTestCase(unittest.TestCase):
     def testDict(self):
         self.assertEquals(self.struct['first'].dict(), dict(self.data[0][1]))
 
+    def testDictImmutable(self):
+        frozen = self.struct.dict(immutable=True)
+        self.assertEquals(frozen['first'], dict(self.data[0][1]))
+        self.assertEquals(frozen['last'], ("list", "of", "strings"))
+        self.assertRaises(TypeError, frozen.__setitem__, 'x', 1)
+        self.assertRaises(TypeError, frozen['first']['dict'].update, {})
+        self.assertEquals(pickle.loads(pickle.dumps(frozen)), frozen)
+        copy = frozen.copy()
+        copy['x'] = 1
+
+    def testDictImmutableCached(self):
+        frozen = self.struct.dict(immutable=True)
+        self.assert_(self.struct.dict(immutable=True) is frozen)
+        self.assert_(self.struct['first'].dict(immutable=True)
+                is frozen['first'])
+        self.struct['first.new'] = 1
+        changed = self.struct.dict(immutable=True)
+        self.assert_(changed is not frozen)
+        self.assertEquals(changed['first']['new'], 1)
+        self.assert_('new' not in frozen['first'])
+        self.assert_(changed['first']['dict'] is frozen['first']['dict'])
+
+    def testDictDeep(self):
+        path = ".".join(["n%d" % i for i in xrange(sys.getrecursionlimit())])
+        self.struct.set(path, 1)
+        self.assertEquals(len(self.struct.dict()), 4)
+
     def testSetShort(self):
         s = struct.Struct()
         s['new'] = True
@@ -161,6 +426,29 @@ class ExpansionTestCase(unittest.TestCase):
         self.assertEquals(root.get('bar'), "omgwtf${foo}")
         self.assertEquals(root.expanditem('bar'), "omgwtfbbq")
 
+    def testLongChain(self):
+        def chain(end):
+            root = struct.Struct()
+            root["k0"] = end
+            for i in xrange(1, length):
+                if i % 2:
+                    root["k%d" % i] = struct.Link("k%d" % (i - 1),
+                                                  root, "k%d" % i)
+                else:
+                    root["k%d" % i] = "${k%d}" % (i - 1)
+            return root
+
+        length = sys.getrecursionlimit() + 100
+        last = "k%d" % (length - 1)
+        root = chain("end")
+        root.expand()
+        self.assertEquals(root.get(last), "end")
+        root = chain("end")
+        root.expand(lazy=True)
+        self.assertEquals(root.get(last), "end")
+        root = chain("${%s}" % last)
+        self.assertRaises(errors.CircularReference, root.expand)
+
     def testExpandDefault(self):
         root = struct.Struct()
         root["foo"] = "bbq"
@@ -185,6 +473,12 @@ class ExpansionTestCase(unittest.TestCase):
         root.expand(ignore_missing=('baz',))
         self.assertEquals(root.get('bar'), "omgwtfbbq${baz}")
 
+    def testExpandDefaultPairs(self):
+        root = struct.Struct()
+        root["bar"] = "${foo}${baz}${zap}"
+        root.expand([('foo', "1"), ('baz', "2")], ['zap'])
+        self.assertEquals(root.get('bar'), "12${zap}")
+
     def testUnexpanded(self):
         root = struct.Struct()
         root["foo"] = "bbq"
@@ -229,6 +523,53 @@ class ExpansionTestCase(unittest.TestCase):
         root["bar"] = "b"
         self.assertEquals(root.expanditem("foo", {'bar': "a"}), "b")
 
+    def testExpandInPlace(self):
+        root = struct.Struct({'foo': "bbq", 'bar': "omgwtf${foo}",
+                              'list': ["${foo}"]})
+        foo = root._get('foo')
+        bar = root._get('bar')
+        item = root['list']._get(0)
+        root.expand()
+        self.assert_(root._get('foo') is foo)
+        self.assert_(isinstance(bar, struct.Leaf))
+        self.assertEquals(root._get('bar'), "omgwtfbbq")
+        self.assert_(root['list']._get(0) is item)
+        self.assertEquals(item, "bbq")
+
+    def testExpandPaths(self):
+        root = struct.Struct({
+            'common': {'domain': "example.com", 'unused': "${nope}"},
+            'a': {'fqdn': "a.${@root.common.domain}"},
+            'b': {'fqdn': "b.${@root.common.domain}"},
+            'c': {'x': "${..a.fqdn}", 'y': "${..b.fqdn}"}})
+        root.expand(paths=['c.x', 'b'])
+        self.assertEquals(root._get('c')._get('x'), "a.example.com")
+        self.assertEquals(root._get('c')._get('y'), "${..b.fqdn}")
+        self.assertEquals(root._get('a')._get('fqdn'), "a.example.com")
+        self.assertEquals(root._get('b')._get('fqdn'), "b.example.com")
+        self.assertEquals(root._get('common')._get('unused'), "${nope}")
+        self.assertRaises(KeyError, root.expand, paths=['bogus'])
+
+    def testExpandMoved(self):
+        sub = struct.Struct({'a': {'b': "${@root.foo}"}})
+        root = struct.Struct({'foo': "bar"})
+        root['x'] = sub
+        self.assert_(root['x.a'].tree_root is root)
+        root.expand()
+        self.assertEquals(root['x.a.b'], "bar")
+
+    def testExpandStats(self):
+        root = struct.Struct()
+        root["foo"] = "bbq"
+        root["bar"] = "${foo}${foo}"
+        root["baz"] = "${foo}${@root.foo}"
+        stats = {}
+        root.expand(stats=stats)
+        self.assertEquals(root.get('baz'), "bbqbbq")
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['hit_rate'], 0.5)
+
     def testCopy(self):
         a = struct.Struct()
         a["foo"] = [ "omgwtf${bar}" ]
@@ -246,3 +587,225 @@ class StringTestCase(unittest.TestCase):
     def testNestedList(self):
         root = struct.Struct({'x': ['a', ['b', 'c']]})
         self.assertEquals(str(root), 'x: ["a" ["b" "c"]]')
+
+    def testNested(self):
+        root = struct.Struct([('a', 1), ('b', {'c': {'d': "x"}, 'e': {}}),
+                              ('f', [])])
+        text = 'a: 1\nb: {\n    c: {\n        d: "x"\n    }\n    e: {}\n}\nf: []'
+        self.assertEquals(root.string(), text)
+        self.assertEquals(root.string(prefix="  "),
+                          "\n".join("  " + l for l in text.split("\n")))
+        self.assertEquals(struct.Struct().string(), "")
+
+    def testWrite(self):
+        root = struct.Struct([('a', 1), ('b', {'c': "x\n"})])
+        out = StringIO.StringIO()
+        root.write(out)
+        self.assertEquals(out.getvalue(), str(root))
+        self.assertEquals("".join(root.iterstring()), str(root))
+
+class JsonTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.struct = struct.Struct([('a', 1), ('b', {'c': "x\n"}),
+                                     ('d', [1.5, None, True, "y"]),
+                                     ('e', {})])
+
+    def testToJson(self):
+        out = StringIO.StringIO()
+        self.struct.to_json(out)
+        self.assertEquals(out.getvalue(), '{"a": 1, "b": {"c": "x\\n"}, '
+                          '"d": [1.5, null, true, "y"], "e": {}}')
+        self.assertEquals("".join(self.struct.iterjson()), out.getvalue())
+
+    def testFromJson(self):
+        text = "".join(self.struct.iterjson())
+        new = struct.Struct.from_json(text)
+        self.assertEquals(new, self.struct)
+        self.assertEquals(new.keys(), ['a', 'b', 'd', 'e'])
+        self.assert_(new['b'].container is new)
+        self.assertEquals(new['b'].node_path, "@root.b")
+        new = struct.Struct.from_json(StringIO.StringIO(text))
+        self.assertEquals(new, self.struct)
+
+    def testFromJsonReferences(self):
+        new = struct.Struct.from_json(
+                '{"a": 1, "b": {"c": "${..a}", "d": ["${@root.a}"]}}')
+        new.expand()
+        self.assertEquals(new['b.c'], "1")
+        self.assertEquals(new['b.d'], ["1"])
+
+    def testFromJsonRepeated(self):
+        new = struct.Struct.from_json(
+                '{"a": [1], "b": "${a}", "c": 1, "a": 2, "b": 3, "c": [4]}')
+        self.assertEquals(new.keys(), ['a', 'b', 'c'])
+        self.assertEquals(new['a'], 2)
+        self.assertEquals(new['b'], 3)
+        self.assertEquals(new['c'], [4])
+
+    def testFromJsonErrors(self):
+        self.assertRaises(errors.StructError, struct.Struct.from_json, '[1]')
+        self.assertRaises(errors.KeyValueError, struct.Struct.from_json,
+                          '{"a": {"b.c": 1}}')
+
+    def testUnrepresentable(self):
+        root = struct.Struct({'a': 1})
+        root['b'] = struct.Link('a', root, 'b')
+        self.assertRaises(errors.StructError, "".join, root.iterjson())
+
+class DiffTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.old = struct.Struct([('a', 1), ('b', {'c': 2, 'd': [1, 2]}),
+                                  ('g', {'h': 1}), ('x', 5)])
+
+    def testSame(self):
+        self.assertEquals(struct.diff(self.old, self.old.copy()),
+                          ([], [], []))
+
+    def testDiff(self):
+        new = self.old.copy()
+        new['b.c'] = 3
+        new['b.n'] = 4
+        new['g'] = 7
+        new['z.q'] = 1
+        del new['x']
+        self.assertEquals(struct.diff(self.old, new),
+                          (['b.n', 'z'], ['x'], ['b.c', 'g']))
+        self.assertEquals(struct.diff(new, self.old),
+                          (['x'], ['b.n', 'z'], ['b.c', 'g']))
+
+    def testList(self):
+        new = self.old.copy()
+        new['b.d'].append(3)
+        self.assertEquals(struct.diff(self.old, new), ([], [], ['b.d']))
+
+    def testHashCollision(self):
+        # hash(-1) == hash(-2) in CPython
+        old = struct.Struct([('x', {'a': -1}), ('y', 1), ('l', [1, -1])])
+        new = struct.Struct([('x', {'a': -2}), ('y', 1), ('l', [1, -2])])
+        self.assertEquals(struct.diff(old, new), ([], [], ['x.a', 'l']))
+
+class FreezeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.struct = struct.Struct([('a', 1), ('b', {'c': 2, 'd': [1, [2]]}),
+                                     ('e', "${a}")])
+
+    def testFreeze(self):
+        frozen = self.struct.freeze()
+        self.assert_(frozen is self.struct)
+        self.assert_(frozen.frozen)
+        self.assert_(frozen['b'].frozen)
+        self.assert_(frozen['b.d'].frozen)
+        self.assertEquals(frozen['b.c'], 2)
+        self.assertEquals(frozen.dict()['b'], {'c': 2, 'd': [1, [2]]})
+
+    def testMutate(self):
+        frozen = self.struct.freeze()
+        self.assertRaises(errors.FrozenError, frozen.set, 'a', 2)
+        self.assertRaises(errors.FrozenError, frozen.set, 'b.x.y', 2)
+        self.assertRaises(errors.FrozenError, frozen.__delitem__, 'b.c')
+        self.assertRaises(errors.FrozenError, frozen.update, {'a': 2})
+        self.assertRaises(errors.FrozenError, frozen.merge, {'a': 2})
+        self.assertRaises(errors.FrozenError, frozen.pop, 'a')
+        self.assertRaises(errors.FrozenError, frozen.clear)
+        self.assertRaises(errors.FrozenError, frozen.expand)
+        self.assertRaises(TypeError, frozen['b.d'].append, 3)
+        self.assertRaises(TypeError, frozen['b.d'][1].sort)
+        self.assertRaises(TypeError, frozen['b.d'].__setslice__, 0, 1, [3])
+        self.assertEquals(frozen.dict(), self.struct.copy().dict())
+
+    def testHash(self):
+        self.assertRaises(TypeError, hash, self.struct)
+        other = self.struct.copy()
+        self.assertEquals(hash(self.struct.freeze()), hash(other.freeze()))
+        self.assertEquals(len(set([self.struct, other])), 1)
+        self.assertEquals(hash(self.struct['b.d']), hash(other['b.d']))
+
+    def testCopy(self):
+        copy = self.struct.freeze().copy()
+        self.assertFalse(copy.frozen)
+        copy['b.c'] = 3
+        copy['b.d'].append(3)
+        self.assertEquals(self.struct['b.c'], 2)
+        self.assertEquals(self.struct['b.d'], [1, [2]])
+
+    def testMove(self):
+        self.struct['x'] = struct.Link('a', self.struct, 'x')
+        frozen = self.struct.freeze()
+        other = struct.Struct()
+        other['x'] = frozen['b']
+        other['y'] = frozen['b.d']
+        other['z'] = frozen['x']
+        other['y'].append(3)
+        self.assert_(frozen['b'].container is frozen)
+        self.assertEquals(frozen['b'].node_path, "@root.b")
+        self.assert_(frozen['b.d'].container is frozen['b'])
+        self.assertEquals(frozen['b.d'], [1, [2]])
+        self.assert_(frozen['x'].container is frozen)
+        self.assertEquals(other['x'].node_path, "@root.x")
+        self.assertFalse(other['x'].frozen)
+
+    def testRejectedMove(self):
+        frozen = self.struct.freeze()
+        other = struct.Struct({'x': {'y': 1}, 'l': [1]})
+        for path in ('b', 'b.x', 'e'):
+            self.assertRaises(errors.FrozenError, frozen.set, path, other['x'])
+        self.assertRaises(errors.FrozenError, frozen.update, other)
+        self.assertRaises(TypeError, frozen['b.d'].__setitem__, 0, other['x'])
+        self.assert_(other['x'].container is other)
+        self.assertEquals(other['x'].node_path, "@root.x")
+        self.assertEquals(other['l'].node_path, "@root.l")
+        self.assertEquals(frozen.keys(), ['a', 'b', 'e'])
+
+    def testLazy(self):
+        self.struct.expand(lazy=True)
+        self.struct.freeze()
+        self.assertEquals(self.struct._expander, None)
+        self.assertEquals(self.struct['e'], "1")
+
+class RevisionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.struct = struct.Struct([('a', 1), ('b', {'c': 2, 'd': [1]}),
+                                     ('e', {'f': "${..a}"})])
+
+    def testSet(self):
+        root, b, e = self.struct.revision, self.struct['b'].revision, \
+                self.struct['e'].revision
+        self.struct['b.c'] = 3
+        self.assert_(self.struct.revision > root)
+        self.assert_(self.struct['b'].revision > b)
+        self.assertEquals(self.struct['e'].revision, e)
+
+    def testMutators(self):
+        b = self.struct['b']
+        for mutate in (lambda: b.__delitem__('c'),
+                       lambda: b.update({'x': 1}),
+                       lambda: self.struct.merge({'b': {'y': 2}}),
+                       lambda: b['d'].append(2),
+                       lambda: b.clear()):
+            root, rev = self.struct.revision, b.revision
+            mutate()
+            self.assert_(self.struct.revision > root)
+            self.assert_(b.revision > rev)
+
+    def testExpand(self):
+        e = self.struct['e'].revision
+        self.struct.expand()
+        self.assert_(self.struct['e'].revision > e)
+
+    def testExpandItem(self):
+        self.struct['g'] = struct.Link('b', self.struct, 'g')
+        root = self.struct.revision
+        self.assertEquals(self.struct.expanditem('g'), self.struct['b'])
+        self.assertEquals(self.struct.expanditem('g.d'), [1])
+        self.assertEquals(self.struct.revision, root)
+
+    def testReplaced(self):
+        seen = self.struct['b'].revision
+        self.struct['b'] = {'c': 2, 'd': [1]}
+        self.assertNotEqual(self.struct['b'].revision, seen)
+        self.assertNotEqual(self.struct.copy().revision,
+                            self.struct.revision)